@@ -22,6 +22,7 @@
 
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_datetime64_any_dtype
 from matplotlib import pyplot as plt
 from tqdm import tqdm
 import os
@@ -103,17 +104,22 @@ class ActivityCounts:
 
     def read_WatchAC(self):
         """Read Smartwatch activity counts if already calculated."""
-        self.WatchAC =pd.read_csv(os.path.join(self.output_folder, self.str_Watch+'.csv.gz'))
+        self.WatchAC = pd.read_parquet(os.path.join(self.output_folder, self.counts_file_path))
     
     def merge_ACs(self):
         """Merge Activity counts of Smartwatch and Actigraph."""
-        self.ActiAC[self.str_time] = pd.to_datetime(self.ActiAC[self.str_time])
-        self.WatchAC[self.str_time] = pd.to_datetime(self.WatchAC[self.str_time])
-        self.data = pd.merge(self.WatchAC, self.ActiAC, on=self.str_time, how='inner', suffixes=(self.str_Watch, self.str_Acti)).reset_index(drop=True)
+        for df in [self.ActiAC, self.WatchAC]:
+            if not is_datetime64_any_dtype(df[self.str_time]):
+                df[self.str_time] = pd.to_datetime(df[self.str_time])
+        watch = self.WatchAC.set_index(self.str_time)
+        acti = self.ActiAC.set_index(self.str_time)
+        self.data = watch.join(acti, how='inner', lsuffix=self.str_Watch, rsuffix=self.str_Acti).reset_index()
         self.data.rename(columns={'AC'+self.str_Watch: self.str_Watch, 'AC'+self.str_Acti: self.str_Acti}, inplace=True)
         self.data = self.data[[self.str_time, self.str_Acti, self.str_Watch]]
-        self.data['diff'] = self.data[self.str_Watch] - self.data[self.str_Acti]
-        self.data['average'] = (self.data[self.str_Watch] + self.data[self.str_Acti]) / 2
+        watch_ac = self.data[self.str_Watch].to_numpy()
+        acti_ac = self.data[self.str_Acti].to_numpy()
+        self.data['diff'] = watch_ac - acti_ac
+        self.data['average'] = (watch_ac + acti_ac) / 2
                 
     def clean_ACs(self):
         """Remove charging time and non-wearing time."""
@@ -129,11 +135,10 @@ class ActivityCounts:
             pct_single_no_wear, final_data = remove_single_non_wearing(rm_data)
             print("Removing time when single device was not wearing", pct_single_no_wear, "%\n")
     
-            self.final_data = final_data.copy()
-            self.final_data['diff'] = self.final_data[self.str_Watch] - self.final_data[self.str_Acti]
-            self.final_data['average'] = (self.final_data[self.str_Watch] + self.final_data[self.str_Acti]) / 2
+            # diff and average are kept from merge_ACs, the removals only drop rows
+            self.final_data = final_data
             
-            final_data.to_csv(os.path.join(self.output_folder, 'ACs.csv.gz'), index=False)
+            final_data.to_csv(os.path.join(self.output_folder, 'ACs.csv.gz'), index=False, compression={'method': 'gzip', 'compresslevel': 1})
             
             self.charging_list.append(pct_charging)
             self.both_no_wear_list.append(pct_both_no_wear)
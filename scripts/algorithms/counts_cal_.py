@@ -22,11 +22,14 @@
 
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_datetime64_any_dtype
 from agcounts.extract import get_counts
 from matplotlib import pyplot as plt
 from tqdm import tqdm
 import os
-from utils.read_file import read_watch_acc_folder, sleep_csv, check_both_zero
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from utils.read_file import read_watch_acc_folder, sleep_csv
 
 
 def get_counts_csv(
@@ -45,97 +48,115 @@ def get_counts_csv(
     rounded_end_time = raw[time_column].max().ceil('T')
     
     idx = pd.date_range(start=rounded_start_time, end=rounded_end_time, freq=sampling_freq, inclusive='left')
-    idx_s = idx.strftime('%Y-%m-%d %H:%M:%S.%f')
-    idx_s = pd.to_datetime(idx_s)
-    missing_time = set(idx_s) - set(raw[time_column])
+    missing_time = idx.difference(pd.DatetimeIndex(raw[time_column]))
     
-    s = pd.DataFrame({time_column: pd.to_datetime(list(missing_time))})
+    s = pd.DataFrame({time_column: missing_time})
     
     s = s.assign(X=0.0, Y=0.0, Z=0.0)
     df = pd.concat([raw,s], axis=0).sort_values(by=[time_column]).reset_index(drop=True)
     
     if time_column is not None:
         ts = df[time_column]
-        ts = pd.to_datetime(ts)
+        if not is_datetime64_any_dtype(ts):
+            ts = pd.to_datetime(ts)
         time_freq = str(epoch) + "S"
         ts = ts.dt.floor(time_freq)
         ts = ts.unique()
         ts = pd.DataFrame(ts, columns=[time_column])
     
-    df = df[["X", "Y", "Z"]]
-
     if verbose:
         print("Converting to array", flush=True)
-    df = np.array(df)
+    df = df[["X", "Y", "Z"]].to_numpy(dtype=np.float64)
     if verbose:
         print("Getting Counts", flush=True)
     counts = get_counts(df, freq=freq, epoch=epoch, fast=fast, verbose=verbose)
     del df
+    # Vector magnitude of the three axes in one pass over the counts array
+    magnitude = np.linalg.norm(counts, axis=1)
     counts = pd.DataFrame(counts, columns=["Axis1", "Axis2", "Axis3"])
-    counts["AC"] = (counts["Axis1"] ** 2 + counts["Axis2"] ** 2 + counts["Axis3"] ** 2) ** 0.5
+    counts["AC"] = magnitude
     ts = ts[0 : counts.shape[0]]
     if time_column is not None:
         counts = pd.concat([ts, counts], axis=1)
     return counts, s
 
 
+def counts_timeslot(samsung_folder, start_time, end_time):
+    """Calculate AC for one wearing duration, return None if no acceleration data is available."""
+    try:
+        df_samsung = read_watch_acc_folder(samsung_folder, start_time, end_time)
+    except Exception as e:
+        print("An exception occurred in complete_samsung:", e)
+        return None
+    
+    if len(df_samsung) == 0:
+        return None
+    
+    counts_sub, miss = get_counts_csv(
+        raw=df_samsung, freq=50, sampling_freq="20ms", epoch=60, verbose=False, time_column="time"
+    )
+    return counts_sub
+
+
 def calculate_AC(samsung_folder, output_folder_p, start_times, end_times, counts_file_path):
     """Calculate AC for each wearing duration and merge results from all durations into one."""
-    counts_watch = pd.DataFrame()
-    df_samsung_whole = pd.DataFrame()
-    
-    for i, el in tqdm(enumerate(start_times.to_numpy())):
-        print("Timeslot", str(i+1), " in ", len(start_times))
-        start_time = start_times[i] 
-        end_time = end_times[i]
-    
-        try:
-            df_samsung = read_watch_acc_folder(samsung_folder, start_time, end_time)
-        except Exception as e:
-            print("An exception occurred in complete_samsung:", e)
-            continue
-        
-        if len(df_samsung) != 0: 
-            df_samsung_whole = pd.concat([df_samsung_whole, df_samsung])
-            
-            counts_sub, miss = get_counts_csv(
-                raw=df_samsung, freq=50, sampling_freq="20ms", epoch=60, verbose=False, time_column="time"
-            )
-            
-            counts_watch = pd.concat([counts_watch, counts_sub])
-    
-    counts_watch.to_csv(os.path.join(output_folder_p, counts_file_path), index=False)
+    print("Timeslots:", len(start_times))
+    
+    # Each wearing duration is independent, calculate them in parallel
+    with ProcessPoolExecutor() as executor:
+        counts_parts = list(tqdm(executor.map(counts_timeslot, repeat(samsung_folder), start_times, end_times), total=len(start_times)))
+    counts_parts = [counts_sub for counts_sub in counts_parts if counts_sub is not None]
+    
+    counts_watch = pd.concat(counts_parts, ignore_index=True) if counts_parts else pd.DataFrame()
+    counts_watch.to_parquet(os.path.join(output_folder_p, counts_file_path), index=False)
     return counts_watch
     
 
+def scan_windows(t_ns, watch, acti, sleep_start_ns, sleep_end_ns, window_ns):
+    """Return the mask of rows to keep after removing windows where both activities are zero outside sleep."""
+    window_id = (t_ns - t_ns.min()) // window_ns
+    n_windows = (t_ns.max() - t_ns.min() - window_ns) // window_ns + 1
+    rows = np.flatnonzero(window_id < n_windows)
+    ids = window_id[rows]
+    
+    # A window is in sleep if its start lies strictly within any pair of sleep start and end time
+    window_starts = t_ns.min() + np.arange(n_windows) * window_ns
+    ws = window_starts[:, None]
+    insleep = ((ws > sleep_start_ns) & (ws < sleep_end_ns)).any(axis=1)
+    
+    # The last row of each window is not considered when checking zeros
+    nonzero = (watch[rows] != 0) | (acti[rows] != 0)
+    _, last_reversed = np.unique(ids[::-1], return_index=True)
+    nonzero[len(ids) - 1 - last_reversed] = False
+    
+    size = np.bincount(ids, minlength=n_windows)
+    nonzero_count = np.bincount(ids, weights=nonzero, minlength=n_windows)
+    nonwear = ~insleep & (size >= 2) & (nonzero_count == 0)
+    
+    keep = np.zeros(len(t_ns), dtype=bool)
+    keep[rows] = ~nonwear[ids]
+    return keep
+
+
 def remove_both_non_wearing(data, sleep_file, str_Watch, str_Acti):
     """Remove windows when both devices activities are zero for 15 minutes outside sleep."""
-    rm_data = pd.DataFrame(columns=data.columns)
-    nonwear_start = []
-    
     # Read each pair of sleep start and end time
     sleep_start, sleep_end = sleep_csv(sleep_file)
+    sleep_start = sleep_start.to_numpy(dtype='datetime64[ns]')
+    sleep_end = sleep_end.to_numpy(dtype='datetime64[ns]')
     
-    for window_start in pd.date_range(start=data['time'].min(), end=data['time'].max() - pd.Timedelta(minutes=15), freq='15T'):
-        insleep = False
-        window_end = window_start + pd.Timedelta(minutes=15)
-        window = data[(data['time'] >= window_start) & (data['time'] < window_end)]
-        
-        for count, _ in enumerate(sleep_start):
-            t0 = sleep_start[count]
-            t1 = sleep_end[count]
-            if (window_start > t0) & (window_start < t1):
-                insleep = True
-                break
-            
-        if insleep == False and len(window) >= 2:
-            if check_both_zero(window.iloc[:-1], str_Watch, str_Acti):
-                nonwear_start.append(window.iloc[0]['time'])
-            else:
-                rm_data = pd.concat([rm_data, window])
-        else:
-            rm_data = pd.concat([rm_data, window])
+    # A pair with a missing time is never sleep, NaT would compare as the smallest int64 in scan_windows
+    valid = ~(np.isnat(sleep_start) | np.isnat(sleep_end))
     
+    keep = scan_windows(
+        data['time'].to_numpy(dtype='datetime64[ns]').view('i8'),
+        data[str_Watch].to_numpy(dtype=float),
+        data[str_Acti].to_numpy(dtype=float),
+        sleep_start[valid].view('i8'),
+        sleep_end[valid].view('i8'),
+        pd.Timedelta(minutes=15).value,
+    )
+    rm_data = data[keep]
     
     pct_both_non_wear = round((len(data) - len(rm_data)) / len(data) * 100, 2)
 
@@ -144,10 +165,11 @@ def remove_both_non_wearing(data, sleep_file, str_Watch, str_Acti):
 
 def remove_single_non_wearing(data):
     """Remove when difference of two ACs is larger than twice of the average ACs or when difference of ACs less than 500."""
-    condition_1 = (data['diff'] < 2 * data['average']) & (data['diff'] > -2 * data['average'])
-    condition_2 = (abs(data['diff']) < 500)
-    rm_data = data[condition_1 | condition_2]
+    abs_diff = np.abs(data['diff'].to_numpy(dtype=float))
+    average = data['average'].to_numpy(dtype=float)
+    mask = (abs_diff < 2 * average) | (abs_diff < 500)
+    rm_data = data.iloc[mask].reset_index(drop=True)
     
-    pct_single_non_wear = round((len(data) - len(rm_data)) / len(data) * 100, 2)
+    pct_single_non_wear = round((1 - mask.mean()) * 100, 2)
     
     return pct_single_non_wear, rm_data
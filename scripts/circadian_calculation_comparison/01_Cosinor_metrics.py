@@ -42,17 +42,19 @@ Output:
 
 from CosinorPy import cosinor, cosinor1, cosinor_nonlin
 import importlib
-importlib.reload(cosinor)
 import numpy as np
 import pandas as pd
 import os
-from sklearn.preprocessing import MinMaxScaler
+# Reload CosinorPy only when it is being edited interactively
+if os.environ.get("COSINOR_RELOAD"):
+    importlib.reload(cosinor)
+from concurrent.futures import ProcessPoolExecutor
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
 from utils.error_handling import folderErrorHandling
-from utils.read_file import load_config
+from utils.read_file import load_config, list_patients
 
 
 ############### Define global parameters ###############
@@ -61,9 +63,9 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 config = load_config(current_dir)
 
 # Input folder and files
-root, input_path, ActiAC_file, WatchAC_file, HR_file, HRV_file, CBT_file = (
+root, input_path, ActiAC_file, WatchAC_file, HR_file, HRV_file, CBT_file, sensor_cache_file = (
     config.get(key, "") for key in [
-        "output_root", "sensor_folder", "ActiAC_file", "AC_file",  "HR_file", "HRV_file", "CBT_file"
+        "output_root", "sensor_folder", "ActiAC_file", "AC_file",  "HR_file", "HRV_file", "CBT_file", "sensor_cache_file"
     ]
 )
 
@@ -93,12 +95,7 @@ str_time, str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, s
 
 str_to_test = [str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4]
 
-subfolders = [
-    f for f in os.listdir(input_folder)
-    if os.path.isdir(os.path.join(input_folder, f)) and f.isdigit()
-]
-
-patient_list = sorted(subfolders, key=lambda x: int(x))
+patient_list = list_patients(input_folder)
 
 
 time_interval = 10 # Aggerate to 10T
@@ -106,15 +103,14 @@ time_interval = 10 # Aggerate to 10T
 
 
 def read_csv_time(patient_ID, file):
-    """Read file and transfer time into datatime format."""
-    df = pd.read_csv(os.path.join(input_folder, patient_ID, file))
-    df[str_time] = pd.to_datetime(df[str_time])
+    """Read file with the pyarrow engine and parse time into datatime format while reading."""
+    df = pd.read_csv(os.path.join(input_folder, patient_ID, file), engine='pyarrow', parse_dates=[str_time])
     return df
 
 
 
-def read_sensor_data(patient_ID): 
-    """Read sensor data and aggregate them into 10-minute interval."""
+def load_sensor_data(patient_ID): 
+    """Read sensor data of each sensor from the sensor files."""
     df_ActiAC = read_csv_time(patient_ID, ActiAC_file)
     df_ActiAC = df_ActiAC.rename(columns={'AC': str_Acti})
     df_ActiAC = df_ActiAC[[str_time, str_Acti]]
@@ -135,27 +131,47 @@ def read_sensor_data(patient_ID):
     return [df_ActiAC, df_WatchAC, df_CBT, df_SkinT, df_HR] + df_HRVs
 
 
-def aggregate_df(list_df):
-    """For ActiAC and WatchAC, aggregate based on sum, for CBT, SKinT and HR, aggregated based on mean"""
-    agg_list = list_df.copy() 
-    agg_list[:2] = [aggregate_sum(elem) for elem in agg_list[:2]]
-    agg_list[2:5] = [aggregate_mean(elem) for elem in agg_list[2:5]]
-    return agg_list
+def split_sensors(cached):
+    """Split the cached long format into one DataFrame per sensor, in the order of load_sensor_data, a sensor without rows is kept empty."""
+    names = [str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4]
+    return [cached.loc[cached['sensor'] == name, [str_time, 'value']].rename(columns={'value': name}).reset_index(drop=True)
+            for name in names]
+
+
+def read_sensor_data(patient_ID):
+    """Read sensor data, reuse the cached sensor data if it is newer than all sensor files."""
+    patient_folder = os.path.join(input_folder, patient_ID)
+    cache_file = os.path.join(patient_folder, sensor_cache_file)
+    sensor_files = [os.path.join(patient_folder, file) for file in [ActiAC_file, WatchAC_file, CBT_file, HR_file, HRV_file]]
     
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) > max(os.path.getmtime(file) for file in sensor_files):
+        return split_sensors(pd.read_parquet(cache_file))
+    
+    list_df = load_sensor_data(patient_ID)
+    
+    # Cache all sensors in long format, one row per measurement, both paths return the sensors split from it
+    cached = pd.concat([df.set_axis([str_time, 'value'], axis=1).assign(sensor=df.columns[-1]) for df in list_df], ignore_index=True)
+    cached.to_parquet(cache_file, index=False)
+    return split_sensors(cached)
 
-def aggregate_mean(df):
-    """Aggregate based on mean."""
-    df.set_index(str_time, inplace=True)
-    df_downsampled = df.resample(str(time_interval) + 'T').mean()
-    df_downsampled.reset_index(inplace=True)  
-    return df_downsampled
 
-def aggregate_sum(df):
-    """Aggregate based on sum"""
-    df.set_index(str_time, inplace=True)
-    df_downsampled = df.resample(str(time_interval) + 'T').sum()
-    df_downsampled.reset_index(inplace=True) 
-    return df_downsampled
+def aggregate_df(list_df):
+    """For ActiAC and WatchAC, aggregate based on sum, for the others, aggregated based on mean. All sensors are resampled in one call."""
+    freq = str(time_interval) + 'T'
+    names = [df.columns[-1] for df in list_df]
+    agg_map = {name: 'sum' if i < 2 else 'mean' for i, name in enumerate(names)}
+    
+    df = pd.concat([elem.set_index(str_time) for elem in list_df])
+    df_downsampled = df.resample(freq).agg(agg_map)
+    
+    # Sum fills empty intervals with 0, keep only the intervals within the recording of each summed sensor
+    for elem, name in zip(list_df[:2], names[:2]):
+        first, last = elem[str_time].min().floor(freq), elem[str_time].max().floor(freq)
+        df_downsampled.loc[(df_downsampled.index < first) | (df_downsampled.index > last), name] = np.nan
+    
+    df_downsampled.reset_index(inplace=True)
+    return [df_downsampled[[str_time, name]] for name in names]
+    
 
 def to_cosinor_format(df, label):
     """Change to the dataformat applied in cosinor model, x is minute index, y is measurement, test is label."""
@@ -165,18 +181,19 @@ def to_cosinor_format(df, label):
     df2['test'] = label
     return df2
 
-def scale_measure(df, scaler):
-    """Scale the measurement"""
+def scale_measure(df):
+    """Scale the measurement into [0, 1], missing values are kept."""
     scaled_df = df.copy() 
-    for column in df.columns:
-        if column == 'y': 
-            scaled_column = scaler.fit_transform(df[column].values.reshape(-1, 1))
-            scaled_df[column] = pd.Series(scaled_column.flatten(), index=df.index)
+    y = df['y'].to_numpy(dtype=float)
+    y_min, y_max = np.nanmin(y), np.nanmax(y)
+    scaled_df['y'] = (y - y_min) / (y_max - y_min) if y_max > y_min else y - y_min
     return scaled_df
 
-def cosinor_metrics(df, time_period, pairs, patient_ID=None, model_csv=None, save_folder=None, plot_figure=None, compare_csv=None):
+def cosinor_metrics(df, time_period, pairs, patient_ID=None, model_file=None, save_folder=None, plot_figure=None, compare_csv=None):
     """Call cosinor functions and calculate cosinor metrics."""
     # Identify the best models and/or the best periods (possible periods can be given as an interval or as a single value).
+    # Each test is fitted separately: the tests have different time points after removing missing values, 
+    # and the statistics kept in the model file (p, q, RSS, peaks, troughs) come from the CosinorPy fit of each test.
     df_results = cosinor.fit_group(df, n_components = [1], period=time_period, plot=False, plot_phase=False) #folder=""
 
     # Get the best fitting periods with criterium 'RSS' (```reverse=False``` means lower is better)
@@ -185,12 +202,13 @@ def cosinor_metrics(df, time_period, pairs, patient_ID=None, model_csv=None, sav
     if patient_ID is not None:
         df_best_fits.insert(loc=0, column='ID', value=patient_ID)
     
-    df_best_fits['acrophase'] = df_best_fits['acrophase'].apply(acro_neg_to_pos)
-    df_best_fits['time'] = df_best_fits['acrophase'].apply(acro_to_time)
-    df_best_fits['hour'] = df_best_fits['acrophase'].apply(acro_to_hour)
+    acrophase = acro_neg_to_pos(df_best_fits['acrophase'].to_numpy(dtype=float))
+    df_best_fits['acrophase'] = acrophase
+    df_best_fits['time'] = acro_to_time(acrophase)
+    df_best_fits['hour'] = acro_to_hour(acrophase)
 
-    if model_csv is not None:
-        df_best_fits.to_csv(model_csv, index=False)
+    if model_file is not None:
+        df_best_fits.to_parquet(model_file, index=False)
     
     if plot_figure is not None:
     # plot these models, by default the criterium is p-value)
@@ -211,61 +229,60 @@ def cosinor_metrics(df, time_period, pairs, patient_ID=None, model_csv=None, sav
     '''
 
 def acro_neg_to_pos(value):
-    """Change the negative acrophase value to positive by adding 2*pi"""
+    """Change the negative acrophase values to positive by adding multiples of 2*pi"""
     two_pi = 2 * np.pi
-    while value < 0:
-        value += two_pi
-    return value
+    return np.where(value < 0, np.mod(value, two_pi), value)
 
 def acro_to_hour(acrophase):
-    """Change the acrophase value to hour (Hour: Minute)"""
+    """Change the acrophase values to hours (Hour: Minute), missing if the fit gave no acrophase"""
     time = acro_to_time(acrophase)
-    hours = int(time)
-    minutes = int((time % 1) * 60)
-    return f'{hours:02d}:{minutes:02d}'
+    valid = np.isfinite(time)
+    hours = np.where(valid, time, 0).astype(int)
+    minutes = ((np.where(valid, time, 0) % 1) * 60).astype(int)
+    return [f'{h:02d}:{m:02d}' if v else None for h, m, v in zip(hours, minutes, valid)]
 
 def acro_to_time(acrophase):
-    """Change the acrophase value to time value"""
+    """Change the acrophase values to time values"""
     time = 24 - 24 * acrophase / (2 * np.pi)
     return time
 
 
-def main():
-    for patient_ID in patient_list:
-        print("="*30)
-        print(patient_ID)
-        
-        sensor_data = read_sensor_data(patient_ID)
+def process_patient(patient_ID):
+    """Calculate cosinor metrics of all sensor data for one individual."""
+    print("="*30)
+    print(patient_ID)
     
-        sensor_data_agg = aggregate_df(sensor_data)
-        
-        cr_data = [to_cosinor_format(df, df.columns[-1]) for df in sensor_data_agg]
-    
-        scaler = MinMaxScaler()
-    
-        cr_data_scaled = [scale_measure(df, scaler) for df in cr_data]
+    sensor_data = read_sensor_data(patient_ID)
+
+    sensor_data_agg = aggregate_df(sensor_data)
     
-        cr_data_mergerd = pd.concat(cr_data_scaled, ignore_index=True)
-        cr_data_mergerd = cr_data_mergerd.dropna(subset=['y'])
+    cr_data = [to_cosinor_format(df, df.columns[-1]) for df in sensor_data_agg]
+
+    cr_data_scaled = [scale_measure(df) for df in cr_data]
+
+    cr_data_mergerd = pd.concat(cr_data_scaled, ignore_index=True)
+    cr_data_mergerd = cr_data_mergerd.dropna(subset=['y'])
+
+    #pairs = (["AC(Actigraph)", "CBT"], )
+    pairs = tuple([[str_Acti, item] for item in str_to_test])
     
-        #pairs = (["AC(Actigraph)", "CBT"], )
-        pairs = tuple([[str_Acti, item] for item in str_to_test])
-        
-        cosinor_metrics(df = cr_data_mergerd, time_period = int(24*60/time_interval), pairs=pairs, patient_ID = patient_ID, model_csv=os.path.join(output_subfolder, patient_ID+"_models.csv"))
-        print("="*30)
+    cosinor_metrics(df = cr_data_mergerd, time_period = int(24*60/time_interval), pairs=pairs, patient_ID = patient_ID, model_file=os.path.join(output_subfolder, patient_ID+"_models.parquet"))
+    print("="*30)
+
+
+def main():
+    # Each individual is independent, fit them in parallel
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(process_patient, patient_list))
         
     #output_strings = ['models', 'cosinor1', 'compare1', 'CI', 'nonlinear', 'bootstrap', 'comparelm1']#, '3comp', 'comparelmbest', 'comparebootstrap']
     output_strings = ['models']
     
     for substr in output_strings:
-        merged_df = pd.DataFrame()
-        
-        filtered_files = [filename for filename in os.listdir(output_subfolder) if substr in filename and filename.endswith('.csv')]
+        filtered_files = [filename for filename in os.listdir(output_subfolder) if substr in filename and filename.endswith('.parquet')]
         sorted_files = sorted(filtered_files, key=lambda x: int(x.split('_')[0]))
         
-        for filename in sorted_files:
-            df = pd.read_csv(os.path.join(output_subfolder, filename))
-            merged_df = pd.concat([merged_df, df])
+        merged_df = pd.concat([pd.read_parquet(os.path.join(output_subfolder, filename)) for filename in sorted_files])
         merged_df.to_csv(os.path.join(output_folder, output_csv), index=False)
     
 
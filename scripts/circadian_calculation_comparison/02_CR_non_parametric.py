@@ -38,8 +38,9 @@ Output:
 """
 
 import os
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
+from concurrent.futures import ProcessPoolExecutor
 import importlib
 # Load the module
 Cosinor_metrics = importlib.import_module("01_Cosinor_metrics")
@@ -47,7 +48,7 @@ read_sensor_data = getattr(Cosinor_metrics, "read_sensor_data")
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
-from utils.read_file import load_config
+from utils.read_file import load_config, list_patients
 
 
 ############### Define global parameters ###############
@@ -84,61 +85,75 @@ str_time, str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, s
 
 str_to_test = [str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4]
 
-subfolders = [
-    f for f in os.listdir(input_folder)
-    if os.path.isdir(os.path.join(input_folder, f)) and f.isdigit()
-]
+patient_list = list_patients(input_folder)
 
-patient_list = sorted(subfolders, key=lambda x: int(x))
+
+def group_mean(values, codes):
+    """Average values sharing the same non-negative integer code, only codes which occur are returned."""
+    counts = np.bincount(codes)
+    sums = np.bincount(codes, weights=values)
+    return sums[counts > 0] / counts[counts > 0]
 
 
 def non_parametrics(data, which_measure):
     """Calculate non-parametric metrics for the specific data from each individual."""
-    data.set_index(str_time, inplace=True)
+    values = data[which_measure].to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    
+    # Minute of the day and hour taken directly from the nanosecond timestamps
+    minutes = data[str_time].to_numpy(dtype='datetime64[ns]').view('i8')[valid] // 60_000_000_000
+    minute_of_day = minutes % (24 * 60)
+    hours = minute_of_day // 60
 
-    d_fraction = data.groupby([data.index.hour, data.index.minute]).mean().var()
+    d_fraction = np.var(group_mean(values[valid], minute_of_day), ddof=1)
 
-    d_daily = data.var()
-    d_across = data.diff(1).pow(2).mean()
+    d_daily = np.var(values[valid], ddof=1)
+    d_across = np.nanmean(np.diff(values) ** 2)
 
     IS = d_fraction / d_daily
     IV = d_across / d_daily
     
-    hourly_activity = data.groupby(data.index.hour)[which_measure].mean()
-    M10 = hourly_activity.nlargest(10).mean()
-    L5 = hourly_activity.nsmallest(5).mean()
+    # Most active 10 hours and least active 5 hours, take all hours if fewer are recorded
+    hourly_activity = group_mean(values[valid], hours)
+    n_hours = len(hourly_activity)
+    M10 = np.partition(hourly_activity, n_hours - min(10, n_hours))[-10:].mean()
+    L5 = np.partition(hourly_activity, min(5, n_hours) - 1)[:5].mean()
     RA = (M10 - L5) / (M10 + L5)
     
-    return [which_measure, IS[0], IV[0], M10, L5, RA]
+    return [which_measure, IS, IV, M10, L5, RA]
 
 
-def scale_measure(df, scaler):
-    """Scale the selected data."""
-    df[df.columns[-1]] = scaler.fit_transform(df[[df.columns[-1]]])
+def scale_measure(df):
+    """Scale the selected data into [0, 1], missing values are kept."""
+    y = df[df.columns[-1]].to_numpy(dtype=float)
+    y_min, y_max = np.nanmin(y), np.nanmax(y)
+    df[df.columns[-1]] = (y - y_min) / (y_max - y_min) if y_max > y_min else y - y_min
     return df
 
 
-def main():
-    non_parametric_whole = pd.DataFrame()
-
-    for patient_ID in patient_list:
-        print("="*30)
-        print(patient_ID)
-        
-        sensor_data = read_sensor_data(patient_ID)
-        
-        #sensor_data_agg = aggregate_df(sensor_data)
-    
-        scaler = MinMaxScaler()
-    
-        sensor_data_scaled = [scale_measure(df, scaler) for df in sensor_data]
+def process_patient(patient_ID):
+    """Calculate non-parametric metrics of all sensor data for one individual."""
+    print("="*30)
+    print(patient_ID)
     
-        non_para_results = [non_parametrics(df, df.columns[-1]) for df in sensor_data_scaled]
-        non_parametric_p = pd.DataFrame(non_para_results, columns=['Measurement', 'IS', 'IV', 'M10', 'L5', 'RA'])
-        non_parametric_p.insert(loc=0, column='ID', value=patient_ID)
+    sensor_data = read_sensor_data(patient_ID)
     
-        non_parametric_whole = pd.concat([non_parametric_whole, non_parametric_p], ignore_index=True)
+    #sensor_data_agg = aggregate_df(sensor_data)
+
+    sensor_data_scaled = [scale_measure(df) for df in sensor_data]
+
+    non_para_results = [non_parametrics(df, df.columns[-1]) for df in sensor_data_scaled]
+    non_parametric_p = pd.DataFrame(non_para_results, columns=['Measurement', 'IS', 'IV', 'M10', 'L5', 'RA'])
+    non_parametric_p.insert(loc=0, column='ID', value=patient_ID)
+    return non_parametric_p
+
+
+def main():
+    # Each individual is independent, calculate them in parallel
+    with ProcessPoolExecutor() as executor:
+        non_parametric_list = list(executor.map(process_patient, patient_list))
     
+    non_parametric_whole = pd.concat(non_parametric_list, ignore_index=True)
     non_parametric_whole.to_csv(os.path.join(output_folder, output_csv), index=False)
     
     
@@ -42,10 +42,13 @@ Output:
 
 from CosinorPy import cosinor, cosinor1, cosinor_nonlin
 import importlib
-importlib.reload(cosinor)
 import pandas as pd
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+# Reload CosinorPy only when it is being edited interactively
+if os.environ.get("COSINOR_RELOAD"):
+    importlib.reload(cosinor)
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
@@ -64,9 +67,9 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 config = load_config(current_dir)
 
 # Input folder and files
-root, input_path, ActiAC_file, WatchAC_file, HR_file, HRV_file, CBT_file = (
+root, input_path, ActiAC_file, WatchAC_file, HR_file, HRV_file, CBT_file, sensor_agg_cache_file = (
     config.get(key, "") for key in [
-        "output_root", "sensor_folder", "ActiAC_file", "AC_file",  "HR_file", "HRV_file", "CBT_file"
+        "output_root", "sensor_folder", "ActiAC_file", "AC_file",  "HR_file", "HRV_file", "CBT_file", "sensor_agg_cache_file"
     ]
 )
 
@@ -98,26 +101,51 @@ patient_list = ['01', '02']
 
 time_interval = 10 # Aggerate to 10T
 
-cr_data_whole = [pd.DataFrame() for _ in range(9)]
+cr_buffers = [[] for _ in range(9)]
 
 which_cr_metric = 4 # Take CR metric HR
 
-def main():
+
+def read_aggregated_data(patient_ID):
+    """Read and aggregate sensor data, reuse the cached aggregation if it is newer than all sensor files."""
+    patient_folder = os.path.join(input_folder, patient_ID)
+    cache_file = os.path.join(patient_folder, f"{time_interval}T_{sensor_agg_cache_file}")
+    sensor_files = [os.path.join(patient_folder, file) for file in [ActiAC_file, WatchAC_file, CBT_file, HR_file, HRV_file]]
     
-    for patient_ID in patient_list:
-        print("="*30)
-        print(patient_ID)
-        
-        sensor_data = read_sensor_data(patient_ID)
-        
-        sensor_data_agg = aggregate_df(sensor_data)
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) > max(os.path.getmtime(file) for file in sensor_files):
+        cached = pd.read_parquet(cache_file)
+        return [cached[[str_time, name]] for name in cached.columns[1:]]
+    
+    sensor_data_agg = aggregate_df(read_sensor_data(patient_ID))
+    
+    # All aggregated sensors share the same time index, cache them as one wide table
+    cached = pd.concat([sensor_data_agg[0]] + [df.iloc[:, 1:] for df in sensor_data_agg[1:]], axis=1)
+    cached.to_parquet(cache_file, compression='zstd', index=False)
+    return sensor_data_agg
 
-        cr_data = [to_cosinor_format(df, patient_ID) for df in sensor_data_agg]
+
+def process_patient(patient_ID):
+    """Read, aggregate and reshape the sensor data of one individual into cosinor format."""
+    print("="*30)
+    print(patient_ID)
+    
+    sensor_data_agg = read_aggregated_data(patient_ID)
+
+    # All aggregated sensors share the same time index, derive the minute index once for all of them
+    x = to_cosinor_format(sensor_data_agg[0], patient_ID)['x'].to_numpy()
+    return [pd.DataFrame({'x': x, 'y': df.iloc[:, -1].to_numpy(), 'test': patient_ID}) for df in sensor_data_agg]
+
+
+def main():
     
-        # Concatenate the circadian data of all participants together
-        for i, df in enumerate(cr_data_whole):
-            cr_data_whole[i] = pd.concat([df, cr_data[i]], ignore_index=True)
+    # Each individual is independent, process them in parallel
+    with ProcessPoolExecutor() as executor:
+        for cr_data in executor.map(process_patient, patient_list):
+            # Collect the circadian data of all participants, concatenated once after the loop
+            for i, df in enumerate(cr_data):
+                cr_buffers[i].append(df)
     
+    cr_data_whole = [pd.concat(bufs, ignore_index=True) for bufs in cr_buffers]
         
     for df in cr_data_whole:
         df.dropna(subset=['y'], inplace=True)
@@ -80,104 +80,109 @@ str_time, str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, s
 sensor_ref = str_Acti
 sensor_to_test = [str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4]
 
+# Columns of the cosinor and non-parametric model files used for the comparison
+CR_COLS = ['ID', 'test', 'amplitude', 'time', 'mesor']
+NP_COLS = ['ID', 'Measurement', 'IS', 'IV', 'M10', 'L5', 'RA']
 
+# The normality test is only printed for exploration, it is not part of the comparison results
+RUN_NORMALITY_TEST = False
 
-def compare_metrics(data, which_sensor, which_metrics):
-    """Calculate comparison metrics (e.g., MAE, RMSE, correlation) for the selected data."""
-    y1 = data.iloc[:, 1]
-    y2 = data.iloc[:, 2]
-    
-    mean_y1 = y1.mean()
-    std_y1 = y1.std()
-    
-    mean_y2 = y2.mean()
-    std_y2 = y2.std()
-    
-    quartiles_y1 = y1.quantile([0.25, 0.75])
-    iqr_y1 = quartiles_y1[0.75] - quartiles_y1[0.25]
-    
-    quartiles_y2 = y2.quantile([0.25, 0.75])
-    iqr_y2 = quartiles_y2[0.75] - quartiles_y2[0.25]
 
-    y1_stat = str(round(mean_y1, 2)) + '(' + str(round(std_y1,2)) + ')' 
-    y2_stat = str(round(mean_y2, 2)) + '(' + str(round(std_y2,2)) + ')' 
 
-    y1_stat2 = str(round(y1.median(), 2)) + '(' + str(round(iqr_y1,2)) + ')' 
-    y2_stat2 = str(round(y2.median(), 2)) + '(' + str(round(iqr_y2,2)) + ')'
-    
-    mae = np.mean(np.abs(y1 - y2))
-    rmse = np.sqrt(np.mean((y1 - y2) ** 2))
+def compare_metrics(ref, tests, sensors, which_metrics):
+    """Calculate comparison metrics (e.g., MAE, RMSE, correlation) of all test sensors against the reference for one metric."""
+    # ref holds one value per individual, tests one column per sensor, missing values are skipped as in pandas
+    mean_ref = np.nanmean(ref)
+    std_ref = np.nanstd(ref, ddof=1)
+    q1_ref, median_ref, q3_ref = np.nanquantile(ref, [0.25, 0.5, 0.75])
     
-    # Test if the data is normal distribution
-    statistic, p_value = stats.shapiro(data)
-    if p_value < 0.05:
-        #print("Data is not normally distributed.")
-        pass
-    else:
-        print("Data appears to be normally distributed.")
+    mean_tests = np.nanmean(tests, axis=0)
+    std_tests = np.nanstd(tests, axis=0, ddof=1)
+    q1_tests, median_tests, q3_tests = np.nanquantile(tests, [0.25, 0.5, 0.75], axis=0)
     
-    # Wilcoxon's signed-rank test statistic
-    t_stat, p_t = wilcoxon(y1, y2)
-
-    #print(f"Wilcoxon's signed-rank test statistic: {statistic}")
-    #print(f"P-value: {p_value}")
+    diff = tests - ref[:, None]
+    n_valid = np.count_nonzero(~np.isnan(diff), axis=0)
+    diff = np.nan_to_num(diff, nan=0.0)
+    mae = np.abs(diff).sum(axis=0) / n_valid
+    rmse = np.sqrt(np.einsum('ij,ij->j', diff, diff) / n_valid)
     
-    #t_stat, p_t = stats.ttest_ind(y1, y2)
-    #print("t-statistic:", t_stat)
-    #print("p-value:", p_t)
+    results = []
+    for j, which_sensor in enumerate(sensors):
+        print("="*30)
+        print(which_sensor, which_metrics)
+        test = tests[:, j]
         
-    corr_coeff, p_val = pearsonr(y1, y2)
-    #print("Correlation coefficient:", corr_coeff, p_val)
-    
-    result = [which_sensor, which_metrics, y1_stat, y2_stat, y1_stat2, y2_stat2, mae, rmse, round(t_stat, 4), round(p_t, 4), round(corr_coeff, 4), round(p_val, 4)]
-
-    return result
-
-
-def calculate_metrics(compare_results, model, metrics, sensors, sensor_ref, model_type):
-    """Calculate comparison metrics for all metrics from all sensor data."""
-    for which_metrics in metrics:
-        for which_sensor in sensors:
-            print("="*30)
-            print(which_sensor, which_metrics)
+        # Test if the data is normal distribution
+        if RUN_NORMALITY_TEST:
+            statistic, p_value = stats.shapiro(np.column_stack([ref, test]))
+            if p_value < 0.05:
+                #print("Data is not normally distributed.")
+                pass
+            else:
+                print("Data appears to be normally distributed.")
+        
+        # Wilcoxon's signed-rank test statistic, the normal approximation avoids exact enumeration for every pair
+        t_stat, p_t = wilcoxon(ref, test, zero_method="wilcox", method="approx")
+
+        #t_stat, p_t = stats.ttest_ind(ref, test)
+        #print("t-statistic:", t_stat)
+        #print("p-value:", p_t)
+            
+        corr_coeff, p_val = pearsonr(ref, test)
+        #print("Correlation coefficient:", corr_coeff, p_val)
+        
+        # Values are kept numeric, they are rounded when the results are written
+        results.append([which_sensor, which_metrics, mean_ref, std_ref, mean_tests[j], std_tests[j], median_ref, q3_ref - q1_ref, 
+                        median_tests[j], q3_tests[j] - q1_tests[j], mae[j], rmse[j], t_stat, p_t, corr_coeff, p_val])
 
-            metrics_reference = model[model['test' if model_type =="CR" else 'Measurement'] == sensor_ref]
-            metrics_chosen = model[model['test' if model_type =="CR" else 'Measurement'] == which_sensor]
-            metrics_reference = metrics_reference.reset_index(drop=True)
-            metrics_chosen = metrics_chosen.reset_index(drop=True)
+    return results
 
-            data = pd.DataFrame({'ID': metrics_reference['ID'], 
-                                 f"{which_metrics}_ref": metrics_reference[which_metrics], 
-                                 f"{which_metrics}_{which_sensor}": metrics_chosen[which_metrics]})
 
-            result = compare_metrics(data, which_sensor, which_metrics)        
+def to_long(model, key, metrics):
+    """Reshape a model file into one row per individual, sensor and metric."""
+    return model.melt(id_vars=['ID', key], value_vars=metrics, var_name='metric', value_name='value').rename(columns={key: 'sensor'})
 
-            column_names = ['CR Metrics', 'Sensor', 'Mean (SD) (ref)', 'Mean (SD) (test)', 'Median (IQR) (ref)', 
-                            'Median (IQR) (test)', 'MAE', 'RMSE', 't-statistic', 'p-value [t]', 
-                            'Correlation coefficient', 'p-value (corr)']
-            df_result = pd.DataFrame([result], columns=column_names)
 
-            compare_results = pd.concat([compare_results, df_result], ignore_index=True)
+def calculate_metrics(wide, metrics, sensors, sensor_ref):
+    """Calculate comparison metrics for all metrics from all sensor data, return one result row per pair."""
+    rows = []
+    for which_metrics in metrics:
+        # Rows are individuals aligned by ID, columns are sensors, the reductions run in double precision
+        # as MAE and RMSE are written without rounding
+        block = wide.loc[which_metrics]
+        ref = block[sensor_ref].to_numpy(dtype=np.float64)
+        tests = block[sensors].to_numpy(dtype=np.float64)
+        
+        rows += compare_metrics(ref, tests, sensors, which_metrics)
     
-    return compare_results
-
-
-
+    return rows
 
 
 def main():
-    cos_model = pd.read_csv(os.path.join(data_folder, cosinor_file))
-    np_model = pd.read_csv(os.path.join(data_folder, np_file))
+    cos_model = pd.read_csv(os.path.join(data_folder, cosinor_file), engine='pyarrow', usecols=CR_COLS)
+    np_model = pd.read_csv(os.path.join(data_folder, np_file), engine='pyarrow', usecols=NP_COLS)
     
     cos_metrics = ['amplitude', 'time', 'mesor'] # time is the 24-hour representation of the acrophase
     np_metrics = ['IS', 'IV', 'M10', 'L5', 'RA']
     
+    # The metrics are stored in single precision, the comparison upcasts them
+    cos_model = cos_model.astype({metric: np.float32 for metric in cos_metrics})
+    np_model = np_model.astype({metric: np.float32 for metric in np_metrics})
+    
+    
+    # Align all metrics of all sensors by ID in one table
+    long = pd.concat([to_long(cos_model, 'test', cos_metrics), to_long(np_model, 'Measurement', np_metrics)], ignore_index=True)
+    wide = long.pivot(index=['metric', 'ID'], columns='sensor', values='value')
     
-    compare_results = pd.DataFrame()
+    rows = calculate_metrics(wide, cos_metrics + np_metrics, sensor_to_test, sensor_ref)
     
-    compare_results = calculate_metrics(compare_results, cos_model, cos_metrics, sensor_to_test, sensor_ref, model_type="CR")
-    compare_results = calculate_metrics(compare_results, np_model, np_metrics, sensor_to_test, sensor_ref, model_type="NP")
+    descriptive_names = ['Mean (ref)', 'SD (ref)', 'Mean (test)', 'SD (test)', 'Median (ref)', 'IQR (ref)', 
+                         'Median (test)', 'IQR (test)']
+    test_names = ['t-statistic', 'p-value [t]', 'Correlation coefficient', 'p-value (corr)']
+    column_names = ['CR Metrics', 'Sensor'] + descriptive_names + ['MAE', 'RMSE'] + test_names
+    compare_results = pd.DataFrame(rows, columns=column_names)
     
+    compare_results = compare_results.round({**{name: 2 for name in descriptive_names}, **{name: 4 for name in test_names}})
     compare_results.to_csv(os.path.join(data_folder, output_csv), index=False)
     
         
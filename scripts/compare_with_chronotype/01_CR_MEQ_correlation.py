@@ -39,17 +39,19 @@ Output:
 
 
 import pandas as pd
-from matplotlib import pyplot as plt
 import os
+from matplotlib import pyplot as plt
+from operator import itemgetter
 import sys
-from scipy.stats import pearsonr
+from scipy.stats import pearsonr, t as t_dist
 import seaborn as sns
 import numpy as np
-import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 from utils.read_file import load_config
 from utils.error_handling import folderErrorHandling
+from utils.visualization import show_figures
+SHOW_FIGURE = show_figures()
 
 
 ############### Define global parameters ###############
@@ -58,21 +60,17 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 config = load_config(current_dir)
 
 # Input folder and files
-root, input_q_path, MEQ_score_file, CR_path, CR_model_file, np_file = (
-    config.get(key, "") for key in [
-        "output_root", "Q_score_folder", "MEQ_score_file", "CR_folder", "CR_model_file", "CR_non_para_file"
-    ]
-)
+root, input_q_path, MEQ_score_file, CR_path, CR_model_file, np_file = itemgetter(
+    "output_root", "Q_score_folder", "MEQ_score_file", "CR_folder", "CR_model_file", "CR_non_para_file"
+)(config)
 
 input_q_folder = os.path.join(root, input_q_path)
 input_CR_folder = os.path.join(root, CR_path)
 
 # Output folder and files
-output_csv, fig_folder_path = (
-    config.get(key, "") for key in [
-        "CR_MEQ_corr", "fig_folder_path"
-    ]
-)
+output_csv, fig_folder_path = itemgetter(
+    "CR_MEQ_corr", "fig_folder_path"
+)(config)
 
 output_folder = os.path.join(root, CR_path)
 
@@ -82,25 +80,40 @@ folderErrorHandling(fig_folder)
 fig_file_path = os.path.join(fig_folder, "Acrophase_MEQ.png")
 
 # Strings
-str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4 = (
-    config.get(key, "") for key in [
-        "str_Acti", "str_Watch",  "str_CBT", "str_SkinT", "str_HR", "str_HRV1", "str_HRV2", "str_HRV3", "str_HRV4"
-    ]
-)
+str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4 = itemgetter(
+    "str_Acti", "str_Watch",  "str_CBT", "str_SkinT", "str_HR", "str_HRV1", "str_HRV2", "str_HRV3", "str_HRV4"
+)(config)
 sensors = [str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4]
 
+# Columns of the cosinor and non-parametric model files used for the correlation
+CR_COLS = ['ID', 'test', 'amplitude', 'time', 'mesor']
+NP_COLS = ['ID', 'Measurement', 'IS', 'IV', 'M10', 'L5', 'RA']
+
+
+def split_by_sensor(df, x, y, sensor):
+    """Split x and y into contiguous arrays for each sensor, pairs with missing values are skipped."""
+    by_sensor = {}
+    for which_sensor, sensor_df in df.groupby(sensor, sort=False):
+        values = sensor_df[[x, y]].to_numpy(dtype=np.float64)
+        values = values[np.isfinite(values).all(axis=1)]
+        by_sensor[which_sensor] = (np.ascontiguousarray(values[:, 0]), np.ascontiguousarray(values[:, 1]))
+    return by_sensor
+
 
 def correlation_group(df, x, y, sensor, group, xlabel):
     """Plot correlation between acrophase of 3 groups (activity, temperature, heart) with MEQ scores."""
     plt.style.use('seaborn-v0_8-colorblind')
     sns.set(font_scale=0.65)  # Adjust the font scale 
-    g = sns.lmplot(data=df, x=x, y=y, hue=sensor, col=group, scatter_kws={"s": 1}, line_kws={'alpha': 0.9, 'linewidth':1}, legend=False)
-    g.set(xlabel=xlabel)
-    g.fig.set_size_inches(7, 2.5)  # Adjust the width and height 
 
     group_names = df[group].unique()
+    group_sensors_all = df.groupby(group, sort=False, observed=True)[sensor].unique()
+    by_sensor = split_by_sensor(df, x, y, sensor)
+    # Keep one color per sensor across all panels
+    palette = dict(zip(df[sensor].unique(), sns.color_palette(n_colors=df[sensor].nunique())))
+    
+    fig, axes = plt.subplots(1, len(group_names), figsize=(7, 2.5), sharex=True, sharey=True, squeeze=False)
     # For each Group create a seperate panel
-    for i, ax in enumerate(g.axes.flat):
+    for i, ax in enumerate(axes.flat):
         ax.set_facecolor('none')  # Transparent background
         
         ax.spines['bottom'].set_color('black')
@@ -109,66 +122,74 @@ def correlation_group(df, x, y, sensor, group, xlabel):
         ax.spines['bottom'].set_linewidth(0.3)
         ax.spines['left'].set_linewidth(0.3)
         
+        ax.set_title(f'{group} = {group_names[i]}')
+        ax.set_xlabel(xlabel)
+        if i == 0:
+            ax.set_ylabel(y)
+        
         # Obtain sensor names in the current group
-        which_group = df[df[group] == group_names[i]]
-        group_sensors = which_group[sensor].unique()
+        group_sensors = group_sensors_all[group_names[i]]
         
-        # For each sensor in the current group, calculate correlation and plot 
-        for sensor_idx, which_sensor in enumerate(group_sensors):
-            #print(which_sensor)
-            sensor_df = df[df[sensor] == which_sensor]
-            r, pvalue = pearsonr(sensor_df[x], sensor_df[y])
+        # For each sensor in the current group, plot the data with its least-squares line
+        for which_sensor in group_sensors:
+            x_values, y_values = by_sensor[which_sensor]
+            
+            r, pvalue = pearsonr(x_values, y_values)
             #print(r, pvalue)
             p_num = 3 if pvalue < 0.001 else (2 if pvalue < 0.01 else (1 if pvalue < 0.05 else 0))
-            ax.collections[sensor_idx*2].set_label(f'{which_sensor} : {r:.4f}'+"*"*int(p_num))
+            ax.scatter(x_values, y_values, s=1, color=palette[which_sensor], label=f'{which_sensor} : {r:.4f}'+"*"*int(p_num))
+            
+            if len(x_values) > 1:
+                slope, intercept = np.polyfit(x_values, y_values, 1)
+                x_line = np.array([x_values.min(), x_values.max()])
+                ax.plot(x_line, slope * x_line + intercept, color=palette[which_sensor], alpha=0.9, linewidth=1)
         
         ax.legend(fontsize=8)
 
     plt.tight_layout()
-    plt.show()
+    if SHOW_FIGURE:
+        plt.show()
 
-    g.savefig(os.path.join(fig_file_path), dpi=300)
+    fig.savefig(os.path.join(fig_file_path), dpi=300)
 
 
-def calculate_correlation(results, model, metrics, sensors, ref_name, meq_score, model_type):
-    """Calculate correlation between CR metrics with MEQ scores."""
-    for which_metrics in metrics:
-        for which_sensor in sensors:
-            print("="*30)
-            print(which_sensor, which_metrics)
-          
-            metrics_chosen = model[model['test' if model_type =="CR" else 'Measurement'] == which_sensor]
-            metrics_chosen = metrics_chosen.reset_index(drop=True)
-
-            data = pd.DataFrame({'ID': meq_score['ID'], 
-                                 f"{ref_name}": meq_score[ref_name], 
-                                 f"{which_metrics}_{which_sensor}": metrics_chosen[which_metrics]})
-
-
-            corr_coeff, p_val = pearsonr(data.iloc[:, 1], data.iloc[:, 2])
-
-            column_names = ['CR Metrics', 'Sensor', 'Correlation coefficient', 'p-value (corr)']
-            
-            data = [which_metrics, which_sensor, corr_coeff, p_val]            
-            df_result = pd.DataFrame(data, index=column_names).T
-
-            results = pd.concat([results, df_result], ignore_index=True)
+def calculate_correlation(model, metrics, sensors, ref_name, meq_score, model_type):
+    """Calculate correlation between CR metrics with MEQ scores, return one result row per pair."""
+    key = 'test' if model_type == "CR" else 'Measurement'
+    pairs = [(which_metrics, which_sensor) for which_metrics in metrics for which_sensor in sensors]
+    
+    # One column per metric and sensor, aligned with the MEQ scores by ID
+    wide = model.pivot(index='ID', columns=key, values=metrics)
+    x = wide[pairs].reindex(meq_score['ID']).to_numpy(dtype=np.float64)
+    y = meq_score[ref_name].to_numpy(dtype=np.float64)
     
-    return results
+    # Pearson correlation of all columns in one matrix product, p-values from the t distribution as in pearsonr
+    n = len(y)
+    x_centered = x - x.mean(axis=0)
+    y_centered = y - y.mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr_coeffs = (x_centered.T @ y_centered) / np.sqrt(np.einsum('ij,ij->j', x_centered, x_centered) * (y_centered @ y_centered))
+        corr_coeffs = np.clip(corr_coeffs, -1.0, 1.0)
+        t_values = corr_coeffs * np.sqrt((n - 2) / (1.0 - corr_coeffs ** 2))
+    p_vals = 2 * t_dist.sf(np.abs(t_values), n - 2)
+    
+    return [(which_metrics, which_sensor, corr_coeff, p_val) for (which_metrics, which_sensor), corr_coeff, p_val in zip(pairs, corr_coeffs, p_vals)]
 
 
 def main():
     ref_name = 'MEQ'
     meq_score = pd.read_csv(os.path.join(input_q_folder, MEQ_score_file))
-    cos_model = pd.read_csv(os.path.join(input_CR_folder, CR_model_file))
-    np_model = pd.read_csv(os.path.join(input_CR_folder, np_file))
+    cos_model = pd.read_csv(os.path.join(input_CR_folder, CR_model_file), engine='pyarrow', usecols=CR_COLS)
+    np_model = pd.read_csv(os.path.join(input_CR_folder, np_file), engine='pyarrow', usecols=NP_COLS)
     
     cos_metrics = ['amplitude', 'time', 'mesor'] # time is the 24-hour representation of the acrophase
     np_metrics = ['IS', 'IV', 'M10', 'L5', 'RA']
     
-    results = pd.DataFrame()
-    results = calculate_correlation(results, cos_model, cos_metrics, sensors, ref_name, meq_score, model_type="CR")
-    results = calculate_correlation(results, np_model, np_metrics, sensors, ref_name, meq_score, model_type="NP")
+    rows = calculate_correlation(cos_model, cos_metrics, sensors, ref_name, meq_score, model_type="CR")
+    rows += calculate_correlation(np_model, np_metrics, sensors, ref_name, meq_score, model_type="NP")
+    
+    column_names = ['CR Metrics', 'Sensor', 'Correlation coefficient', 'p-value (corr)']
+    results = pd.DataFrame(rows, columns=column_names)
     results.to_csv(os.path.join(output_folder, output_csv), index=False)
     
     ### Plot the correlation between MEQ and acrophase
@@ -177,7 +198,10 @@ def main():
     cos_model.rename(columns={"test": sensor_type}, inplace=True)    
     df_merged = pd.merge(cos_model, meq_score)
     data_acro = df_merged[['ID', sensor_type, cosinor_metrics_plot, ref_name]]
-    data_acro['Group'] = np.where(data_acro[sensor_type].isin([str_Acti, str_Watch]), 'Activity', np.where(data_acro[sensor_type].isin([str_CBT, str_SkinT]), 'Temperature', 'Heart'))
+    # Activity and temperature sensors are mapped explicitly, all other sensors belong to heart
+    group_codes = {str_Acti: 0, str_Watch: 0, str_CBT: 1, str_SkinT: 1}
+    codes = data_acro[sensor_type].map(group_codes).fillna(2).to_numpy(dtype=np.int8)
+    data_acro['Group'] = pd.Categorical.from_codes(codes, categories=['Activity', 'Temperature', 'Heart'])
     
     correlation_group(df=data_acro, x=cosinor_metrics_plot, y=ref_name, sensor=sensor_type, group="Group", xlabel='Acrophase [h]')
 
@@ -42,20 +42,24 @@ Output:
 
 
 import pandas as pd
-from matplotlib import pyplot as plt
+import numpy as np
 import os
+import matplotlib
+from matplotlib import pyplot as plt
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 import statsmodels.api as sm
-from sklearn.feature_selection import SelectKBest, f_regression
+from sklearn.feature_selection import f_regression
 import seaborn as sns
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
-from scipy.stats import pearsonr
-from sklearn.model_selection import train_test_split
-from statsmodels.stats.outliers_influence import variance_inflation_factor
-from sklearn.preprocessing import LabelEncoder
-from utils.read_file import load_config
+from scipy.stats import t as t_dist
+from utils.read_file import load_config, cached_read
 from utils.error_handling import folderErrorHandling
+from utils.visualization import show_figures
+SHOW_FIGURE = show_figures()
 
 
 ############### Define global parameters ###############
@@ -64,21 +68,17 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 config = load_config(current_dir)
 
 # Input folder and files
-root, input_q_path, MEQ_score_file, CR_path, CR_model_file, age_gender_file = (
-    config.get(key, "") for key in [
-        "output_root", "Q_score_folder", "MEQ_score_file", "CR_folder", "CR_model_file", "baseline_output"
-    ]
-)
+root, input_q_path, MEQ_score_file, CR_path, CR_model_file, age_gender_file = itemgetter(
+    "output_root", "Q_score_folder", "MEQ_score_file", "CR_folder", "CR_model_file", "baseline_output"
+)(config)
 
 input_q_folder = os.path.join(root, input_q_path)
 input_CR_folder = os.path.join(root, CR_path)
 
 # Output folder and files
-output_coe_csv, output_res_csv, output_coe_ag_csv, output_res_ag_csv, fig_folder_path = (
-    config.get(key, "") for key in [
-        "Pred_coe_file", "Pred_res_file", "Pred_coe_file_ag", "Pred_res_file_ag", "fig_folder_path"
-    ]
-)
+output_coe_csv, output_res_csv, output_coe_ag_csv, output_res_ag_csv, fig_folder_path = itemgetter(
+    "Pred_coe_file", "Pred_res_file", "Pred_coe_file_ag", "Pred_res_file_ag", "fig_folder_path"
+)(config)
 
 output_folder = os.path.join(root, CR_path)
 
@@ -89,16 +89,48 @@ fig_file_path = os.path.join(fig_folder, "MEQ_prediction.png")
 
 
 # Strings
-str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4 = (
-    config.get(key, "") for key in [
-        "str_Acti", "str_Watch",  "str_CBT", "str_SkinT", "str_HR", "str_HRV1", "str_HRV2", "str_HRV3", "str_HRV4"
-    ]
-)
+str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4 = itemgetter(
+    "str_Acti", "str_Watch",  "str_CBT", "str_SkinT", "str_HR", "str_HRV1", "str_HRV2", "str_HRV3", "str_HRV4"
+)(config)
+
+
+lr_coe_names = ["Variable", "Coefficients [95% CI] (VIF)"]
+lr_res_names = ["Variable", "R-squared", "Adjusted R-squared", "F-statistic"]
+
 
+def ols_1d(x, y):
+    """Fit the single regression model in closed form, return slope, its 95% CI, R-squared, adjusted R-squared, F-statistic and predictions."""
+    n = len(x)
+    x_mean, y_mean = x.mean(), y.mean()
+    sxx = np.dot(x - x_mean, x - x_mean)
+    sxy = np.dot(x - x_mean, y - y_mean)
+    syy = np.dot(y - y_mean, y - y_mean)
+    
+    beta = sxy / sxx
+    alpha = y_mean - beta * x_mean
+    y_pred = alpha + beta * x
+    
+    rss = np.dot(y - y_pred, y - y_pred)
+    se = np.sqrt(rss / (n - 2) / sxx)
+    t_crit = t_dist.ppf(0.975, n - 2)
+    
+    rsquared = 1 - rss / syy
+    rsquared_adj = 1 - (1 - rsquared) * (n - 1) / (n - 2)
+    fvalue = rsquared * (n - 2) / (1 - rsquared)
+    return beta, beta - t_crit * se, beta + t_crit * se, rsquared, rsquared_adj, fvalue, y_pred
 
-def lr_calculation(X, y, var, lr_coe_whole, lr_res_whole):
-    """Calculate linear regression model and return correlation and model metrics."""
-    X_cons = sm.add_constant(X)
+
+def lr_calculation(X, y, var):
+    """Calculate linear regression model, return coefficient rows, model metrics row and predictions."""
+    # Single regression model
+    if type(var) == str:
+        beta, ci_lower, ci_upper, rsquared, rsquared_adj, fvalue, y_pred = ols_1d(np.ravel(X), y)
+        lr_coe_rows = [[f"{var}", f"{round(beta, 2)}[{round(ci_lower, 2)},{round(ci_upper, 2)}]"]]
+        lr_res = [var, "{:.2f}".format(rsquared), "{:.2f}".format(rsquared_adj), "{:.2f}".format(fvalue)]
+        return lr_coe_rows, lr_res, y_pred
+    
+    # Multiple regression model, X and y are float arrays and the constant is prepended directly
+    X_cons = np.column_stack([np.ones(len(X)), X])
     mod = sm.OLS(y, X_cons)
     results = mod.fit()
     y_pred = results.predict(X_cons)
@@ -106,30 +138,32 @@ def lr_calculation(X, y, var, lr_coe_whole, lr_res_whole):
 
     coef_with_ci = results.params.round(2)
     ci = results.conf_int() 
-    lr_coe_names = ["Variable", "Coefficients [95% CI] (VIF)"]
     
+    # VIF of each predictor is the diagonal of the inverse correlation matrix, computed once for all coefficients,
+    # a constant predictor has no correlation and an infinite VIF
+    varying = np.ptp(X, axis=0) > 0
+    vif = np.full(X.shape[1], np.inf)
+    if varying.any():
+        vif[varying] = np.diag(np.linalg.pinv(np.atleast_2d(np.corrcoef(X[:, varying], rowvar=False))))
+    
+    lr_coe_rows = []
     for i, coef in enumerate(coef_with_ci):
         if i == 0: # constant is not recorded
             pass
         else:
-            ci_lower, ci_upper = round(ci.iloc[i, 0], 2), round(ci.iloc[i, 1], 2)   
-            # Single regression model
-            if type(var) == str:
-                lr_coe = [f"{var}", f"{coef}[{ci_lower},{ci_upper}]"]
-            # Multiple regression model
-            else:    
-                vif = [variance_inflation_factor(X_cons, i) for i in range(X_cons.shape[1])]
-                lr_coe = [f"{var}:{var[i-1]}", f"{coef}[{ci_lower},{ci_upper}], {round(vif[i], 2)}"]
-
-            df_lr_coe = pd.DataFrame([lr_coe], columns=lr_coe_names)
-            lr_coe_whole = pd.concat([lr_coe_whole, df_lr_coe], ignore_index=True)
+            ci_lower, ci_upper = round(ci[i, 0], 2), round(ci[i, 1], 2)   
+            lr_coe = [f"{var}:{var[i-1]}", f"{coef}[{ci_lower},{ci_upper}], {round(vif[i-1], 2)}"]
+            lr_coe_rows.append(lr_coe)
             
-    lr_res_names = ["Variable", "R-squared", "Adjusted R-squared", "F-statistic"]
     lr_res = [var, "{:.2f}".format(results.rsquared), "{:.2f}".format(results.rsquared_adj), "{:.2f}".format(results.fvalue)]
-    df_lr_res = pd.DataFrame([lr_res], columns=lr_res_names)
-    lr_res_whole = pd.concat([lr_res_whole, df_lr_res], ignore_index=True)
     
-    return lr_coe_whole, lr_res_whole, y_pred
+    return lr_coe_rows, lr_res, y_pred
+
+
+def lr_models(X, y, var, age_gender):
+    """Calculate linear regression model of the features alone and with age and gender as control variables."""
+    new_column = ([var] if type(var) == str else var) + ["Age", "Gender"]
+    return lr_calculation(X, y, var), lr_calculation(np.column_stack([X, age_gender]), y, new_column)
 
 
 
@@ -145,7 +179,17 @@ def corr_diag_plot(df):
     # Map diagonal plots with print_column_names
     g.map_diag(print_column_names)
     #g.map_diag(sns.histplot, kde=True)
-    g.map_upper(corrfunc, cmap=plt.get_cmap('RdBu'))#, norm=plt.Normalize(vmin=-.5, vmax=.5))
+    # Correlations and p-values of all pairs are computed once and looked up in each upper cell
+    values = df.to_numpy(dtype=np.float64)
+    n = len(values)
+    corr = np.clip(np.corrcoef(values, rowvar=False), -1.0, 1.0)
+    with np.errstate(divide='ignore'):
+        t_values = corr * np.sqrt((n - 2) / (1.0 - corr ** 2))
+    # Only the upper cells are annotated, the p-values of all of them are converted in one vectorized call
+    rows, cols = np.triu_indices(len(df.columns), k=1)
+    pvals = 2 * t_dist.sf(np.abs(t_values[rows, cols]), n - 2)
+    pair_stats = {(df.columns[j], df.columns[i]): (corr[i, j], p) for i, j, p in zip(rows, cols, pvals)}
+    g.map_upper(corrfunc, cmap=matplotlib.colormaps['RdBu'], pair_stats=pair_stats)#, norm=plt.Normalize(vmin=-.5, vmax=.5))
     
     
     for ax in g.axes.flatten():
@@ -172,7 +216,7 @@ def corr_diag_plot(df):
     
     cbar_ax = g.fig.add_axes([1.003, 0.1, 0.015, 0.8])  # Adjust the position and size as needed
     scaled = 1
-    colormap = plt.cm.get_cmap('RdBu') # 'plasma' or 'viridis'
+    colormap = matplotlib.colormaps['RdBu'] # 'plasma' or 'viridis'
     colors = colormap(scaled) 
     smp = plt.cm.ScalarMappable(cmap=colormap)
     smp.set_clim(vmin=-1.0, vmax=1.0)
@@ -181,7 +225,8 @@ def corr_diag_plot(df):
     cbar.set_label('Correlation Coefficient', fontsize=8)
     cbar.ax.tick_params(labelsize=8, width = 0.4, length = 1)   # set your label size here
     
-    plt.show()
+    if SHOW_FIGURE:
+        plt.show()
     g.savefig(os.path.join(fig_file_path), dpi=300)
     
 
@@ -192,7 +237,7 @@ def corrfunc(x, y, **kwds):
     ax = plt.gca()
     ax.tick_params(bottom=False, top=False, left=False, right=False)
     sns.despine(ax=ax, bottom=True, top=True, left=True, right=True)
-    r, pvalue = pearsonr(x, y)
+    r, pvalue = kwds['pair_stats'][x.name, y.name]
     facecolor = cmap((r+1)/2)
     #facecolor = cmap(norm(r))
     num=0
@@ -229,16 +274,16 @@ def main():
     metrics_focus = 'time' # Acrophase representation in 24 h
     sensors_focus = [str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV3]
     
-    meq_score = pd.read_csv(os.path.join(input_q_folder, MEQ_score_file))
-    cos_model = pd.read_csv(os.path.join(input_CR_folder, CR_model_file))
-    age_gender = pd.read_csv(os.path.join(input_q_folder, age_gender_file))
+    meq_score = cached_read(os.path.join(input_q_folder, MEQ_score_file))
+    cos_model = cached_read(os.path.join(input_CR_folder, CR_model_file))
+    age_gender = cached_read(os.path.join(input_q_folder, age_gender_file), categorical=['Gender'])
     
     k_min, k_max = 2, 6 # Minimal and maximum of the multiple feature number
     
-    # Age and gender as control variables, encode gender as dummy variable
-    label_encoder = LabelEncoder()
-    age_gender['Gender'] = label_encoder.fit_transform(age_gender['Gender'])
-    age_gender = age_gender[['Age', 'Gender']]
+    # Age and gender as control variables, encode gender as dummy variable (Female - 0, Male - 1)
+    # Categories are sorted, so the int8 codes match LabelEncoder without its extra pass over the column
+    age_gender['Gender'] = age_gender['Gender'].cat.codes
+    age_gender = np.ascontiguousarray(age_gender[['Age', 'Gender']].to_numpy(dtype=np.float64))
     
     ## Merge MEQ scores and CR metrics
     data = {ref_name: meq_score[ref_name]}
@@ -251,52 +296,51 @@ def main():
     ### Seperate features and ground truth
     all_features = data.drop(columns=[ref_name])
     multiple_features = data.drop(columns=[ref_name, str_Acti])
-    y = data[ref_name]
+    y = data[ref_name].to_numpy(dtype=np.float64)
     
-    lr_res_whole = pd.DataFrame()
-    lr_coe_whole = pd.DataFrame()
+    # Result rows are collected in lists and written once at the end
+    lr_res_whole = []
+    lr_coe_whole = []
     
-    lr_res_ag = pd.DataFrame()
-    lr_coe_ag = pd.DataFrame()
+    lr_res_ag = []
+    lr_coe_ag = []
     
     # Single linear regression model
-    for var in all_features:
-        X = all_features[var].values.reshape(-1, 1)
-        #X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.10, random_state=42)
-        lr_coe_whole, lr_res_whole, _ = lr_calculation(X, y, var, lr_coe_whole, lr_res_whole)
-        
-        # Add age and gender as control variable
-        X_ag = pd.concat([pd.DataFrame(X, columns=[var]), age_gender], axis=1).to_numpy()
-        new_column = [var, "Age", "Gender"]
-        lr_coe_ag, lr_res_ag, _ = lr_calculation(X_ag, y, new_column, lr_coe_ag, lr_res_ag)
+    models = [(all_features[var].to_numpy(dtype=np.float64).reshape(-1, 1), var) for var in all_features]
     
     # Multiple linear regression model
+    # F-scores do not depend on k, rank the features once and take the top k (in column order) as SelectKBest does
+    X = multiple_features.to_numpy(dtype=np.float64)
+    f_scores, _ = f_regression(X, y)
+    ranking = np.argsort(f_scores, kind='mergesort')
+    
     for num_fea in range(k_min, k_max+1):
-        X = multiple_features
-        
-        k_best = SelectKBest(score_func=f_regression, k=num_fea)  # Select the top k features 
-        X_topk = k_best.fit_transform(X, y)
-        selected_feature_names = X.columns[k_best.get_support()]
+        selected = np.sort(ranking[-num_fea:])  # Select the top k features 
+        models.append((X[:, selected], multiple_features.columns[selected].to_list()))
+    
+    # Each model is independent, fit them in parallel (NumPy releases the GIL), results keep the model order
+    with ThreadPoolExecutor() as executor:
+        results = list(executor.map(lr_models, [X for X, _ in models], repeat(y), [var for _, var in models], repeat(age_gender)))
     
-        var = selected_feature_names.to_list()
-        lr_coe_whole, lr_res_whole, y_pred = lr_calculation(X_topk, y, var,lr_coe_whole, lr_res_whole)
+    for (coe_rows, lr_res, y_pred), (coe_rows_ag, lr_res_ag_row, _) in results:
+        lr_coe_whole += coe_rows
+        lr_res_whole.append(lr_res)
         
         # Add age and gender as control variable
-        X_ag = pd.concat([pd.DataFrame(X_topk), age_gender], axis=1).to_numpy()
-        new_column = var + ["Age", "Gender"]
-        lr_coe_ag, lr_res_ag, _ = lr_calculation(X_ag, y, new_column, lr_coe_ag, lr_res_ag)
-        
-        # Plot prediction for the last multiple regression model
-        if num_fea == k_max:
-            df_viz = pd.DataFrame(X_topk, columns=selected_feature_names)
-            df_viz["Predictions"] = y_pred
-            corr_diag_plot(df_viz)
+        lr_coe_ag += coe_rows_ag
+        lr_res_ag.append(lr_res_ag_row)
+    
+    # Plot prediction for the last multiple regression model
+    X_topk, var = models[-1]
+    df_viz = pd.DataFrame(X_topk, columns=var)
+    df_viz["Predictions"] = y_pred
+    corr_diag_plot(df_viz)
     
-    lr_coe_whole.to_csv(os.path.join(output_folder, output_coe_csv), index=False)
-    lr_res_whole.to_csv(os.path.join(output_folder, output_res_csv), index=False)
+    pd.DataFrame(lr_coe_whole, columns=lr_coe_names).to_csv(os.path.join(output_folder, output_coe_csv), index=False)
+    pd.DataFrame(lr_res_whole, columns=lr_res_names).to_csv(os.path.join(output_folder, output_res_csv), index=False)
     
-    lr_coe_ag.to_csv(os.path.join(output_folder, output_coe_ag_csv), index=False)
-    lr_res_ag.to_csv(os.path.join(output_folder, output_res_ag_csv), index=False)
+    pd.DataFrame(lr_coe_ag, columns=lr_coe_names).to_csv(os.path.join(output_folder, output_coe_ag_csv), index=False)
+    pd.DataFrame(lr_res_ag, columns=lr_res_names).to_csv(os.path.join(output_folder, output_res_ag_csv), index=False)
     
 
 if __name__ == "__main__":
@@ -34,8 +34,10 @@ Output:
 - fig_file_path: File path of the PCA circle.
 """
 
-import matplotlib.pyplot as plt
 import os
+import matplotlib
+import matplotlib.pyplot as plt
+from operator import itemgetter
 import pandas as pd
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -46,8 +48,10 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
 from adjustText import adjust_text
 from matplotlib.colors import LinearSegmentedColormap
-from utils.read_file import load_config
+from utils.read_file import load_config, cached_read
 from utils.error_handling import folderErrorHandling
+from utils.visualization import show_figures
+SHOW_FIGURE = show_figures()
 
 ############### Define global parameters ###############
 
@@ -56,21 +60,17 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 config = load_config(current_dir)
 
 # Input folder and files
-root, cr_path, cosinor_file, np_file = (
-    config.get(key, "") for key in [
-        "output_root", "CR_folder", "CR_model_file", "CR_non_para_file"
-    ]
-)
+root, cr_path, cosinor_file, np_file = itemgetter(
+    "output_root", "CR_folder", "CR_model_file", "CR_non_para_file"
+)(config)
 
 input_folder = os.path.join(root, cr_path)
 
 
 # Output folder and files
-fig_folder_path, = (
-    config.get(key, "") for key in [
-        "fig_folder_path",
-    ]
-)
+fig_folder_path = itemgetter(
+    "fig_folder_path"
+)(config)
 
 output_folder = os.path.join(root, cr_path)
 
@@ -81,11 +81,9 @@ fig_file_path = os.path.join(fig_folder, "PCA.png")
 
 
 # Strings
-str_ID, str_HRV1, str_HRV2, str_HRV3, str_HRV4 = (
-    config.get(key, "") for key in [
-        "str_ID", "str_HRV1", "str_HRV2", "str_HRV3", "str_HRV4"
-    ]
-)
+str_ID, str_HRV1, str_HRV2, str_HRV3, str_HRV4 = itemgetter(
+    "str_ID", "str_HRV1", "str_HRV2", "str_HRV3", "str_HRV4"
+)(config)
 strs_not_relevant = [str_ID, str_HRV2, str_HRV4]
 
 
@@ -105,45 +103,38 @@ def pca_circle(pca_data, title):
     
     feature_names = list(pca_data)
     
-    ccircle = []
-    eucl_dist = []
+    # Correlation of each standardized feature with the two components, StandardScaler uses the population variance
+    n = len(X)
+    ccircle = pca.components_.T * np.sqrt(pca.explained_variance_ * (n - 1) / n)
+    eucl_dist = np.linalg.norm(ccircle, axis=1)
     texts = []
-    for i,j in enumerate(X .T):
-        corr1 = np.corrcoef(j,Xpca[:,0])[0,1]
-        corr2 = np.corrcoef(j,Xpca[:,1])[0,1]
-        ccircle.append((corr1, corr2))
-        eucl_dist.append(np.sqrt(corr1**2 + corr2**2))
         
     fig, axs = plt.subplots(figsize=(3.5, 3.5), dpi=300)
     
-    for i,j in enumerate(eucl_dist):
-        
-        original_cmap = plt.cm.RdBu
-        new_cmap = LinearSegmentedColormap.from_list('winter_half', original_cmap(range(int(original_cmap.N / 4 * 1), int(original_cmap.N / 4 * 3))))    
-        arrow_col = new_cmap((eucl_dist[i] - np.array(eucl_dist).min())/\
-                                (np.array(eucl_dist).max() - np.array(eucl_dist).min()) )
-        axs.arrow(0,0, # Arrows start at the origin
-                 ccircle[i][0],  #0 for PC1
-                 ccircle[i][1],  #1 for PC2
-                 lw = 2, # line width
-                 length_includes_head=True, 
-                 color = arrow_col,
-                 fc = arrow_col,
-                 head_width=0.05,
-                 head_length=0.05)
-        
+    original_cmap = matplotlib.colormaps['RdBu']
+    new_cmap = LinearSegmentedColormap.from_list('winter_half', original_cmap(range(int(original_cmap.N / 4 * 1), int(original_cmap.N / 4 * 3))))    
+    arrow_cols = new_cmap((eucl_dist - eucl_dist.min()) / (eucl_dist.max() - eucl_dist.min()))
+    
+    # All arrows start at the origin and are drawn as one collection, 0 for PC1, 1 for PC2
+    zeros = np.zeros(len(ccircle))
+    axs.quiver(zeros, zeros, ccircle[:, 0], ccircle[:, 1], color=arrow_cols, angles='xy', scale_units='xy', scale=1, 
+               width=0.008, headwidth=3, headlength=3, headaxislength=2.7)
+    
+    for i in range(len(ccircle)):
         texts.append(axs.text(ccircle[i][0] * 1.05, ccircle[i][1] * 1.05, feature_names[i], fontsize=8, bbox=dict(facecolor='lightgray', edgecolor='none', boxstyle='round, pad=0.05')))
         #axs.text(ccircle[i][0]*1.15,ccircle[i][1]*1.15, feature_names[i], fontsize=10, bbox=dict(facecolor='lightgray', boxstyle='round, pad=0.1'))
-        axs.xaxis.set_tick_params(width=0.3, length = 0.5)
-        axs.yaxis.set_tick_params(width=0.3, length = 0.5)
+    
+    axs.xaxis.set_tick_params(width=0.3, length = 0.5)
+    axs.yaxis.set_tick_params(width=0.3, length = 0.5)
 
+    # Quiver does not update the data limits, fix the limits before the labels are adjusted
+    plt.xlim([-1.05, 1.05])
+    plt.ylim([-1.05, 1.05]) 
     adjust_text(texts, ax=axs)#, only_move={'points':'x', 'texts':'x'})
     
     # Draw the unit circle, for clarity
     circle = Circle((0, 0), 1, facecolor='none', edgecolor=(0.5, 0.5, 0.5), linewidth=1, alpha=1)
     axs.add_patch(circle)
-    plt.xlim([-1.05, 1.05])
-    plt.ylim([-1.05, 1.05]) 
     plt.xticks(fontsize=8)
     plt.yticks(fontsize=8)
     axs.set_xlabel(f"Principal component 1 ({labels[0]:.2f}%)",  fontsize=8)
@@ -165,22 +156,20 @@ def pca_circle(pca_data, title):
     
     plt.savefig(fig_file_path, dpi=300)
 
-    plt.show()
+    if SHOW_FIGURE:
+        plt.show()
 
 
 def main():
     
-    cos_model = pd.read_csv(os.path.join(input_folder, cosinor_file))
-    np_model = pd.read_csv(os.path.join(input_folder, np_file))
-    
-    cr_metric_sd = cos_model[['ID', 'test','amplitude', 'time', 'mesor']]
-    cr_metric_sd.rename(columns={'test': 'Measurement', 'time': 'Acrophase'}, inplace=True)
-    complete_data = pd.merge(cr_metric_sd, np_model, on=['ID', 'Measurement'], how='inner')
-    complete_data_metric = complete_data[['ID', 'Measurement', 'Acrophase']].pivot(index='ID', columns='Measurement', values='Acrophase')
+    # Standardization and PCA for the circle plot do not need double precision
+    cos_model = cached_read(os.path.join(input_folder, cosinor_file), downcast=True)
+    np_model = cached_read(os.path.join(input_folder, np_file))
     
-    complete_data_metric = complete_data_metric.reset_index()
-
-    complete_data_metric = complete_data_metric.drop(columns=strs_not_relevant)
+    # Keep acrophases of the (ID, sensor) pairs which also have non-parametric metrics, without the irrelevant sensors
+    in_np_model = pd.MultiIndex.from_frame(cos_model[['ID', 'test']]).isin(pd.MultiIndex.from_frame(np_model[['ID', 'Measurement']]))
+    acrophase = cos_model.loc[in_np_model & ~cos_model['test'].isin(strs_not_relevant), ['ID', 'test', 'time']]
+    complete_data_metric = acrophase.pivot(index='ID', columns='test', values='time')
     
     pca_circle(complete_data_metric, "Acrophase")
     
@@ -42,12 +42,14 @@ Output:
 
 
 import pandas as pd
+import numpy as np
 import os
+from operator import itemgetter
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 import scipy.stats as stats
-from utils.read_file import load_config
+from utils.read_file import load_config, cached_read
 
 ############### Define global parameters ###############
 # Load configuration and define variables
@@ -55,31 +57,25 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 config = load_config(current_dir)
 
 # Input folder and files
-root, input_q_path, MEQ_score_file, CR_path, CR_model_file, age_gender_file = (
-    config.get(key, "") for key in [
-        "output_root", "Q_score_folder", "MEQ_score_file", "CR_folder", "CR_model_file", "baseline_output"
-    ]
-)
+root, input_q_path, MEQ_score_file, CR_path, CR_model_file, age_gender_file = itemgetter(
+    "output_root", "Q_score_folder", "MEQ_score_file", "CR_folder", "CR_model_file", "baseline_output"
+)(config)
 
 input_q_folder = os.path.join(root, input_q_path)
 input_CR_folder = os.path.join(root, CR_path)
 
 # Output folder and files
-output_csv, = (
-    config.get(key, "") for key in [
-        "Group_comparison_file"
-    ]
-)
+output_csv = itemgetter(
+    "Group_comparison_file"
+)(config)
 
 output_folder = os.path.join(root, CR_path)
 
 
 # Strings
-str_ID, str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4 = (
-    config.get(key, "") for key in [
-        "str_ID", "str_Acti", "str_Watch",  "str_CBT", "str_SkinT", "str_HR", "str_HRV1", "str_HRV2", "str_HRV3", "str_HRV4"
-    ]
-)
+str_ID, str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4 = itemgetter(
+    "str_ID", "str_Acti", "str_Watch",  "str_CBT", "str_SkinT", "str_HR", "str_HRV1", "str_HRV2", "str_HRV3", "str_HRV4"
+)(config)
 
 ref_name = 'MEQ'
 metrics_focus = 'time' # Acrophase representation in 24 h
@@ -89,6 +85,9 @@ sensors_focus = [str_Acti, str_Watch, str_CBT, str_SkinT, str_HR, str_HRV1, str_
 EI_border = 42
 IM_border = 58    
 
+# Print summary statistics of each chronotype group
+VERBOSE = False
+
 
 
 def med_iqr(df):
@@ -123,74 +122,91 @@ def test_normality_homogeneity(df1, df2, df3):
         #print("Variances appear to be equal between groups.")
 
 
-def KWtest(df1, df2, df3):
-    """Perform Kruskal–Wallis test for for group comparison."""
-    f_statistic, p_value = stats.kruskal(df1, df2, df3)    
-    return round(f_statistic, 2), round(p_value, 4)
+def pair_rank_sum(ranks, values, other_sorted):
+    """Rank sum of values within a pair of groups, derived from their ranks among all groups by removing the other group."""
+    less = np.searchsorted(other_sorted, values, side='left')
+    equal = np.searchsorted(other_sorted, values, side='right') - less
+    return np.sum(ranks - less - 0.5 * equal)
 
 
-def Wtest(df1, df2, df3):
-    """Perform the Wilcoxon rank-sum test for pairwise group comparison."""
-    stat1, p_value1 = stats.ranksums(df1, df2)
-    stat2, p_value2 = stats.ranksums(df2, df3)
-    stat3, p_value3 = stats.ranksums(df1, df3)
-    return round(stat1, 2), round(p_value1, 4), round(stat2, 2), round(p_value2, 4), round(stat3, 2), round(p_value3, 4), 
+def rank_tests(df1, df2, df3):
+    """Perform Kruskal–Wallis test and the pairwise Wilcoxon rank-sum tests from one ranking of all groups."""
+    groups = [np.asarray(df, dtype=np.float64) for df in [df1, df2, df3]]
+    sizes = np.array([len(group) for group in groups])
+    pooled = np.concatenate(groups)
+    if np.isnan(pooled).any():
+        return (np.nan,) * 8
+    
+    ranks = stats.rankdata(pooled)
+    group_ranks = np.split(ranks, np.cumsum(sizes)[:-1])
+    
+    # Kruskal–Wallis H with tie correction
+    n = len(pooled)
+    h_statistic = 12.0 / (n * (n + 1)) * sum(r.sum() ** 2 / len(r) for r in group_ranks) - 3 * (n + 1)
+    _, ties = np.unique(pooled, return_counts=True)
+    h_statistic /= 1 - np.sum(ties ** 3 - ties) / (n ** 3 - n)
+    p_KW = stats.chi2.sf(h_statistic, len(groups) - 1)
+    results = [round(h_statistic, 2), round(p_KW, 4)]
+    
+    # Wilcoxon rank-sum z for (Evening, Intermediate), (Intermediate, Morning), (Evening, Morning)
+    for first, second, other in [(0, 1, 2), (1, 2, 0), (0, 2, 1)]:
+        n1, n2 = sizes[first], sizes[second]
+        rank_sum = pair_rank_sum(group_ranks[first], groups[first], np.sort(groups[other]))
+        z = (rank_sum - n1 * (n1 + n2 + 1) / 2.0) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+        results += [round(z, 2), round(2 * stats.norm.sf(abs(z)), 4)]
+    
+    return tuple(results)
 
 
 def custom_describe(df):
     """Summary statistics for numerical and categorical columns"""
     
-    # Column time: Median and IQR
-    median_col1 = df['time'].median()
-    iqr_col1 = df['time'].quantile(0.75) - df['time'].quantile(0.25)
-    
-    # Columns age, MEQ: Average and Standard Deviation
-    avg_col2 = df['Age'].mean()
-    std_col2 = df['Age'].std()
-    
-    avg_col3 = df['MEQ'].mean()
-    std_col3 = df['MEQ'].std()
+    # Column time: Median and IQR, columns age, MEQ: Average and Standard Deviation
+    summary = df[['time', 'Age', 'MEQ']].agg(['median', 'mean', 'std'])
+    q1_col1, q3_col1 = df['time'].quantile([0.25, 0.75])
     
     # Gender: Percentage
-    female_percentage = (df['Gender'].value_counts(normalize=True) * 100)['Female']
+    female_percentage = (df['Gender'] == 'Female').mean() * 100
     
     num_rows = len(df)
 
-    print(f"Acrophase: Median = {median_col1:.2f}, IQR = {iqr_col1:.2f}")
-    print(f"Age: Average = {avg_col2:.2f}, Std = {std_col2:.2f}")
-    print(f"MEQ: Average = {avg_col3:.2f}, Std = {std_col3:.2f}")
+    print(f"Acrophase: Median = {summary.at['median', 'time']:.2f}, IQR = {q3_col1 - q1_col1:.2f}")
+    print(f"Age: Average = {summary.at['mean', 'Age']:.2f}, Std = {summary.at['std', 'Age']:.2f}")
+    print(f"MEQ: Average = {summary.at['mean', 'MEQ']:.2f}, Std = {summary.at['std', 'MEQ']:.2f}")
     print(f"Percentage of Females: {female_percentage:.2f}%")
     print(f"Number of samples: {num_rows:.2f}\n")
 
 def main():
-    meq_score = pd.read_csv(os.path.join(input_q_folder, MEQ_score_file))
-    cos_model = pd.read_csv(os.path.join(input_CR_folder, CR_model_file))
-    age_gender = pd.read_csv(os.path.join(input_q_folder, age_gender_file))
+    meq_score = cached_read(os.path.join(input_q_folder, MEQ_score_file))
+    cos_model = cached_read(os.path.join(input_CR_folder, CR_model_file))
+    age_gender = cached_read(os.path.join(input_q_folder, age_gender_file), categorical=['Gender'])
 
     output_col = ['Sensor', 'Kruskal–Wallis test', 'p-value (f)', 'Wilcoxon rank-sum test  (EI)', 'p-value (t)', 'Wilcoxon rank-sum test  (IM)', 'p-value (t)', 'Wilcoxon rank-sum test  (EM)', 'p-value (t)']
     print(meq_score[ref_name].describe())
     
-    compare_results = pd.DataFrame()
+    compare_results = []
 
+    # Merge acrophase of all sensors, MEQ scores and demographics (age, gender) once
+    data_ag = cos_model.loc[cos_model['test'].isin(sensors_focus), [str_ID, 'test', metrics_focus]]
+    data_ag = data_ag.merge(meq_score[[str_ID, ref_name]], on=str_ID).merge(age_gender, on=str_ID)
+    data_ag = data_ag.dropna(subset=[ref_name])
+    
+    # Chronotype group, 0 - Evening, 1 - Intermediate, 2 - Morning
+    meq = data_ag[ref_name].to_numpy()
+    data_ag['chronotype'] = (meq >= EI_border).astype(np.int8) + (meq > IM_border)
+    groups = dict(tuple(data_ag.groupby(['test', 'chronotype'], sort=False)))
+    
     for which_sensor in sensors_focus:
         print(which_sensor, "*"*30)
-        
-        metrics_chosen = cos_model[cos_model['test'] == which_sensor]
-        metrics_chosen = metrics_chosen.reset_index(drop=True)
-        
-        # Merge MEQ scores, acrophase and demographics (age, gender)
-        data = pd.DataFrame({str_ID: meq_score[str_ID], ref_name: meq_score[ref_name], metrics_focus : metrics_chosen[metrics_focus]  })
-        data_ag = pd.merge(data, age_gender, on=str_ID)
     
         # group1 - Evening, group 2 - Intermediate , group3 - Morning
-        group1 = data_ag[data_ag[ref_name] < EI_border]
-        group2 = data_ag[(data_ag[ref_name] >= EI_border) & (data_ag[ref_name] <= IM_border)]
-        group3 = data_ag[data_ag[ref_name] > IM_border]
+        group1, group2, group3 = (groups.get((which_sensor, chronotype), data_ag.iloc[:0]) for chronotype in range(3))
         
         # Acrophase for each group
         group1_acro, group2_acro, group3_acro = (group[metrics_focus] for group in [group1, group2, group3])
     
-        [custom_describe(group) for group in [group1, group2, group3]]
+        if VERBOSE:
+            [custom_describe(group) for group in [group1, group2, group3]]
         
         med1, iqr1 = med_iqr(group1_acro)
         
@@ -198,12 +214,11 @@ def main():
         test_normality_homogeneity(group1_acro, group2_acro, group3_acro)
     
         # Comparison test
-        f_KW, p_KW = KWtest(group1_acro, group2_acro, group3_acro)
-        t_W1, p_W1, t_W2, p_W2, t_W3, p_W3 = Wtest(group1_acro, group2_acro, group3_acro)
+        f_KW, p_KW, t_W1, p_W1, t_W2, p_W2, t_W3, p_W3 = rank_tests(group1_acro, group2_acro, group3_acro)
         
-        df_result = pd.DataFrame([[which_sensor, f_KW, p_KW, t_W1, p_W1, t_W2, p_W2, t_W3, p_W3]], columns=output_col)
-        compare_results = pd.concat([compare_results, df_result], ignore_index=True)
-        compare_results.to_csv(os.path.join(output_folder, output_csv), index=False)
+        compare_results.append([which_sensor, f_KW, p_KW, t_W1, p_W1, t_W2, p_W2, t_W3, p_W3])
+    
+    pd.DataFrame(compare_results, columns=output_col).to_csv(os.path.join(output_folder, output_csv), index=False)
     
 
 
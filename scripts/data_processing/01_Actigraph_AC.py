@@ -40,14 +40,15 @@ Output:
 """
 
 import pandas as pd
+import numpy as np
 import os
 import sys
-import sys
+from concurrent.futures import ProcessPoolExecutor
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
 from algorithms.ActivityCounts import ActivityCounts
-from utils.read_file import load_config
+from utils.read_file import load_config, write_csv, list_patients, cached_read
 from utils.error_handling import folderErrorHandling
 
 ############### Define global parameters ###############
@@ -81,55 +82,63 @@ time_folder = os.path.join(output_root, time_path)
 
 miss_file_path = os.path.join(stats_folder, Acti_miss_file)
 
-subfolders = [
-    f for f in os.listdir(input_folder)
-    if os.path.isdir(os.path.join(input_folder, f)) and f.isdigit()
-]
-
-patient_list = sorted(subfolders, key=lambda x: int(x))
+patient_list = list_patients(input_folder)
 
 def non_wear_start_end_time(time_folder_p):
     """Obtain each pair of non-wearing start and end time."""
-    non_wearing_times= pd.read_csv(os.path.join(time_folder_p, acti_non_wear_time))  
-    nw_start_times = pd.to_datetime(non_wearing_times['period_start'])
-    nw_end_times = pd.to_datetime(non_wearing_times['period_end'])
+    non_wearing_times= cached_read(os.path.join(time_folder_p, acti_non_wear_time), parse_dates=['period_start', 'period_end'])  
+    nw_start_times = non_wearing_times['period_start']
+    nw_end_times = non_wearing_times['period_end']
     return nw_start_times, nw_end_times
 
 def get_real_ActiAC(df, nw_start_times, nw_end_times):
     """Remove the parts that Actigraph was not wearing."""    
-    mask = pd.Series(True, index=df.index)
-    for start_time, end_time in zip(nw_start_times, nw_end_times):
-        mask &= ~df['time'].between(start_time, end_time)
-    filtered_df = df[mask]    
+    if len(nw_start_times) == 0:
+        return df
+    
+    # Sort non-wearing periods by start, the running maximum of ends also covers overlapping periods
+    starts = nw_start_times.to_numpy(dtype='datetime64[ns]').view('i8')
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = np.maximum.accumulate(nw_end_times.to_numpy(dtype='datetime64[ns]').view('i8')[order])
+    
+    # A time is not worn if it lies within (both ends included) the last period starting before it
+    t = df['time'].to_numpy(dtype='datetime64[ns]').view('i8')
+    last = np.searchsorted(starts, t, side='right') - 1
+    non_wear = (last >= 0) & (ends[np.maximum(last, 0)] >= t)
+    filtered_df = df[~non_wear]    
     return filtered_df
 
 
-def main():
-    non_wearing_list = []
+def process_patient(patient_ID):
+    """Save Actigraph counts of one individual after removing non-wearing time, return the percentage of non-wearing time."""
+    input_folder_p = os.path.join(input_folder, patient_ID)
+    time_folder_p = os.path.join(time_folder, patient_ID)
+    output_folder_p = os.path.join(output_folder, patient_ID)
+    folderErrorHandling(output_folder_p)
 
-    for patient_ID in patient_list:
-        input_folder_p = os.path.join(input_folder, patient_ID)
-        time_folder_p = os.path.join(time_folder, patient_ID)
-        output_folder_p = os.path.join(output_folder, patient_ID)
-        folderErrorHandling(output_folder_p)
+    watch_times= cached_read(os.path.join(time_folder_p, watch_acc_time), parse_dates=['Start', 'End'])  
 
-        watch_times= pd.read_csv(os.path.join(time_folder_p, watch_acc_time))  
+    # Obtain whole ActiAC across the study period
+    patient_object = ActivityCounts(input_folder_p, patient_ID, watch_times, acti_folder_path = acti_folder_path)
+    
+    patient_object.get_ActiAC()
+    whole_ActiAC = patient_object.ActiAC
+    
+    # Obtain non-wearing time of Actigraph
+    nw_start_times, nw_end_times = non_wear_start_end_time(time_folder_p)
+    
+    # Obtain real Actigraph counts after removing non-wearing time
+    real_ActiAC = get_real_ActiAC(whole_ActiAC, nw_start_times, nw_end_times)
+    write_csv(real_ActiAC, os.path.join(output_folder_p, counts_file_path))
 
-        # Obtain whole ActiAC across the study period
-        patient_object = ActivityCounts(input_folder_p, patient_ID, watch_times, acti_folder_path = acti_folder_path)
-        
-        patient_object.get_ActiAC()
-        whole_ActiAC = patient_object.ActiAC
-        
-        # Obtain non-wearing time of Actigraph
-        nw_start_times, nw_end_times = non_wear_start_end_time(time_folder_p)
-        
-        # Obtain real Actigraph counts after removing non-wearing time
-        real_ActiAC = get_real_ActiAC(whole_ActiAC, nw_start_times, nw_end_times)
-        real_ActiAC.to_csv(os.path.join(output_folder_p, counts_file_path), index=False)
+    return round((len(whole_ActiAC) - len(real_ActiAC)) / len(whole_ActiAC) * 100, 2)
 
-        pct_non_wear = round((len(whole_ActiAC) - len(real_ActiAC)) / len(whole_ActiAC) * 100, 2)
-        non_wearing_list.append(pct_non_wear)
+
+def main():
+    # Each individual is independent, process them in parallel
+    with ProcessPoolExecutor() as executor:
+        non_wearing_list = list(executor.map(process_patient, patient_list))
         
     non_wearing_df = pd.DataFrame({'ID': patient_list, 'ActiAC-No-Wear [%]': non_wearing_list})
     non_wearing_df.to_csv(miss_file_path, index=False) 
@@ -50,7 +50,7 @@ import os
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
-from utils.read_file import check_both_zero, sleep_csv,read_watch_acc_folder, load_config
+from utils.read_file import check_both_zero, sleep_csv,read_watch_acc_folder, load_config, list_patients, cached_read
 from algorithms.ActivityCounts import ActivityCounts
 
 ############### Define global parameters ###############
@@ -93,12 +93,7 @@ str_ID, str_Acti, str_Watch, str_time = (
 
 #patient_list = [f"{num:02}" for num in range(1, 3)]
 
-subfolders = [
-    f for f in os.listdir(input_folder)
-    if os.path.isdir(os.path.join(input_folder, f)) and f.isdigit()
-]
-
-patient_list = sorted(subfolders, key=lambda x: int(x))
+patient_list = list_patients(input_folder)
 
 header_row = [str_ID, 'MAE', 'RMSE', 'Mean Difference', 'LoA', 't-statistic', 'p-value [t]', 'Correlation coefficient', 'p-value [corr]']    
 
@@ -107,25 +102,26 @@ charging_list, both_no_wear_list, single_no_wear_list = [], [], []
 
 
 def main():
-    with open(compare_file_path, mode='w', newline='') as csv_file:
-
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(header_row)
+    compare_rows = [header_row]
         
-        for patient_ID in patient_list:
-            input_folder_p = os.path.join(input_folder, patient_ID)
-            time_folder_p = os.path.join(time_folder, patient_ID)
-            output_folder_p = os.path.join(output_folder, patient_ID)
-            
-            watch_times= pd.read_csv(os.path.join(time_folder_p, watch_acc_time))  
+    for patient_ID in patient_list:
+        input_folder_p = os.path.join(input_folder, patient_ID)
+        time_folder_p = os.path.join(time_folder, patient_ID)
+        output_folder_p = os.path.join(output_folder, patient_ID)
+        
+        watch_times= cached_read(os.path.join(time_folder_p, watch_acc_time), parse_dates=['Start', 'End'])  
 
-            patient_object = ActivityCounts(input_folder_p, patient_ID, watch_times, time_folder_p, output_folder_p, fig_folder_path, stats_folder, 
-                                            watch_folder_path, acti_folder_path, str_Acti, str_Watch, str_time, counts_file_path, sleep_file_name,
-                                            charging_list, both_no_wear_list, single_no_wear_list)
-            
-            patient_object.process()
-            
-            csv_writer.writerow(patient_object.row_data)
+        patient_object = ActivityCounts(input_folder_p, patient_ID, watch_times, time_folder_p, output_folder_p, fig_folder_path, stats_folder, 
+                                        watch_folder_path, acti_folder_path, str_Acti, str_Watch, str_time, counts_file_path, sleep_file_name,
+                                        charging_list, both_no_wear_list, single_no_wear_list)
+        
+        patient_object.process()
+        
+        compare_rows.append(patient_object.row_data)
+    
+    # Comparison rows of all participants are written at once, csv quotes the LoA pair as one field
+    with open(compare_file_path, mode='w', newline='') as csv_file:
+        csv.writer(csv_file).writerows(compare_rows)
             
     miss_df = pd.DataFrame({str_ID: patient_list, 'Watch-No-Wear [%]': patient_object.charging_list, 'Both-No-Wear [%]': patient_object.both_no_wear_list, 'Single-No-Wear [%]': patient_object.single_no_wear_list})
     miss_df.to_csv(miss_file_path, index=False) 
@@ -40,11 +40,13 @@ Output:
 import pandas as pd
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from matplotlib import pyplot as plt
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
-from utils.read_file import core_csv, load_config
-from utils.visualization import scatter
+from utils.read_file import core_csv, load_config, write_csv, list_patients
+from utils.visualization import scatter, headless
 
 ############### Define global parameters ###############
 # Load configuration and define variables
@@ -80,51 +82,51 @@ str_ID, str_time, str_CBT, str_SkinT = (
     ]
 )
 
-subfolders = [
-    f for f in os.listdir(input_folder)
-    if os.path.isdir(os.path.join(input_folder, f)) and f.isdigit()
-]
+patient_list = list_patients(input_folder)
 
-patient_list = sorted(subfolders, key=lambda x: int(x))
+# Save the temperature figure of each individual, disable for faster batch runs
+PLOT_FIGURE = True
 
 #patient_list = [f"{num:02}" for num in range(1, 39) if num not in [30, 36]]
 
 
 def core_miss_pct(df_core, start_time, end_time):
     """Calculate CORE miss time."""
-    expected_range = pd.date_range(start=start_time, end=end_time, freq='1min')
-    existing_df = df_core[str_time]   
-    existing_df = existing_df.drop_duplicates(keep='last')
-
-    expected_df = pd.DataFrame({'DateTime': expected_range})        
-    expected_df = expected_df.drop_duplicates(keep='last')
+    # Number of minutes from start to end time (both included) and number of distinct recorded times
+    n_expected = (pd.Timestamp(end_time) - pd.Timestamp(start_time)) // pd.Timedelta(minutes=1) + 1
+    n_existing = df_core[str_time].nunique(dropna=False)
     
-    pct_non_wear = round((len(expected_df) - len(existing_df)) / len(expected_df) * 100, 2)
+    pct_non_wear = round((n_expected - n_existing) / n_expected * 100, 2)
     return pct_non_wear
             
 
-def main():
-    times= pd.read_csv(time_file)  
-    no_wear_list = []
-
-    for patient_ID in patient_list:    
-        print("*"*20)
-        print(patient_ID)
-        input_file = os.path.join(input_folder, patient_ID, input_core_file)
-        data_folder_p = os.path.join(data_folder, patient_ID)
+def process_patient(patient_ID, times):
+    """Save valid core and skin temperature of one individual, plot them and return the percentage of miss time."""
+    print("*"*20)
+    print(patient_ID)
+    input_file = os.path.join(input_folder, patient_ID, input_core_file)
+    data_folder_p = os.path.join(data_folder, patient_ID)
 
-        # Read core time, remove invalid data and save
-        df_core, start_time, end_time = core_csv(input_file, times, patient_ID)
-        df_core.to_csv(os.path.join(data_folder_p, core_file_name), index=False)
-        
-        # Visualize CBT and SkinT
+    # Read core time, remove invalid data and save
+    df_core, start_time, end_time = core_csv(input_file, times, patient_ID)
+    write_csv(df_core, os.path.join(data_folder_p, core_file_name))
+    
+    # Visualize CBT and SkinT
+    if PLOT_FIGURE:
         fig_folder_p = os.path.join(data_folder, patient_ID, fig_folder_path)
         with plt.style.context('seaborn'):
             scatter(df_core[str_time], df_core[str_CBT], df_core[str_SkinT], str_CBT, str_SkinT, plot_save=True, fig_folder=fig_folder_p,  ylim_low = "min")
-            
-        # Calculate the miss time
-        pct_non_wear = core_miss_pct(df_core, start_time, end_time)
-        no_wear_list.append(pct_non_wear)
+        
+    # Calculate the miss time
+    return core_miss_pct(df_core, start_time, end_time)
+
+
+def main():
+    times= pd.read_csv(time_file)  
+
+    # Each individual is independent, process them in parallel, the workers only save figures
+    with ProcessPoolExecutor(initializer=headless) as executor:
+        no_wear_list = list(executor.map(process_patient, patient_list, repeat(times)))
     
     # Save miss time
     core_miss_df = pd.DataFrame({str_ID: patient_list, 'Core-No-Wear [%]': no_wear_list})
@@ -41,13 +41,13 @@ import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
 import os
-from sklearn.preprocessing import MinMaxScaler
+from concurrent.futures import ProcessPoolExecutor
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
-from utils.read_file import read_hr_folder, load_config
-from utils.visualization import scatter
+from utils.read_file import read_hr_folder, load_config, write_csv, list_patients, cached_read
+from utils.visualization import scatter, headless
 from utils.error_handling import folderErrorHandling
 
 
@@ -81,79 +81,109 @@ str_time, str_HR, str_HRV1, str_HRV2, str_HRV3, str_HRV4, str_acc = (
     ]
 )
 
-subfolders = [
-    f for f in os.listdir(input_folder)
-    if os.path.isdir(os.path.join(input_folder, f)) and f.isdigit()
-]
-
-patient_list = sorted(subfolders, key=lambda x: int(x))
-
-
-def calculate_hrv(data):
-    """Calculate 4 HRV metrics from RR interval."""
-    if len(data) > 5:
-        nn_intervals = data['hrIbi']
-        # Calculate Mean RR interval: Mean of the SD of all RR intervalsin the segment
-        mean_rr = np.mean(nn_intervals)
-        # Calculate SDNN:  Standard deviation of all RR intervals
-        sdnn = np.std(nn_intervals)
-        # Calculate RMSSD (Root Mean Square of Successive Differences): Square root of the mean of the sum of squares of differences between adjacent RR intervals
-        rmssd = np.sqrt(np.mean(np.diff(nn_intervals) ** 2))
-        # Calculate pNN50 (Percentage of NN50 Intervals): Percentage of differences between adjacent RR intervals that are greater than 50 msec
-        nn50_count = sum(np.abs(np.diff(nn_intervals)) > 50)
-        total_intervals = len(nn_intervals)
-        pnn50 = (nn50_count / total_intervals) * 100
-        return [mean_rr, sdnn, rmssd, pnn50]
-    else:
-        return None
+patient_list = list_patients(input_folder)
 
+# Save the heart rate and activity figure of each individual, disable for faster batch runs
+PLOT_FIGURE = True
 
-def main():
-    for patient_ID in patient_list:        
-        input_folder_p = os.path.join(input_folder, patient_ID)
-        data_folder_p = os.path.join(data_folder, patient_ID)
 
-        df_hr = read_hr_folder(os.path.join(input_folder_p, hr_folder_path))
-        df_hr.to_csv(os.path.join(data_folder_p, hr_file_name), index=False)
+def calculate_hrv(times, nn_intervals):
+    """Calculate 4 HRV metrics from RR interval for each 10-minute window with more than 5 intervals."""
+    if len(times) == 0:
+        return times.astype('datetime64[ns]'), *(np.empty(0) for _ in range(4))
+    
+    # Sort by time (stable, as the window grouping does) so that each window is one contiguous block
+    order = np.argsort(times, kind='stable')
+    windows = times[order].astype('datetime64[ns]').astype('datetime64[10m]')
+    nn_intervals = nn_intervals[order].astype(np.float64)
+    
+    starts = np.flatnonzero(np.r_[True, windows[1:] != windows[:-1]])
+    total_intervals = np.diff(np.r_[starts, len(windows)])
+    
+    # Calculate Mean RR interval: Mean of the SD of all RR intervalsin the segment
+    mean_rr = np.add.reduceat(nn_intervals, starts) / total_intervals
+    # Calculate SDNN:  Standard deviation of all RR intervals
+    deviation = nn_intervals - np.repeat(mean_rr, total_intervals)
+    sdnn = np.sqrt(np.add.reduceat(deviation ** 2, starts) / total_intervals)
+    
+    # Differences between adjacent RR intervals, the first interval of each window has no predecessor
+    diff = np.empty_like(nn_intervals)
+    np.subtract(nn_intervals[1:], nn_intervals[:-1], out=diff[1:])
+    diff[starts] = 0.0
+    # Calculate RMSSD (Root Mean Square of Successive Differences): Square root of the mean of the sum of squares of differences between adjacent RR intervals
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmssd = np.sqrt(np.add.reduceat(diff * diff, starts) / (total_intervals - 1))
+    # Calculate pNN50 (Percentage of NN50 Intervals): Percentage of differences between adjacent RR intervals that are greater than 50 msec
+    nn50_count = np.add.reduceat(np.abs(diff) > 50, starts, dtype=np.int64)
+    pnn50 = (nn50_count / total_intervals) * 100
+    
+    valid = total_intervals > 5
+    return windows[starts][valid].astype('datetime64[ns]'), mean_rr[valid], sdnn[valid], rmssd[valid], pnn50[valid]
+
+
+def min_max_scale(values):
+    """Scale values to the range [0, 1], constant values are scaled to 0 (as in MinMaxScaler)."""
+    values = np.asarray(values, dtype=np.float32)
+    low, high = values.min(), values.max()
+    return (values - low) / (high - low) if high > low else np.zeros_like(values)
+
+
+def plot_hr_activity(df_hr, patient_ID):
+    """Plot normalized heart rate and Actigraph activity counts of one individual over time."""
+    print("Compare heart rate and acceleration ....\n")
+    # Correlation between ActiAC and heart rate
+    df_acc = cached_read(os.path.join(data_folder, patient_ID, ac_file_name), parse_dates=[str_time])
             
-        # delete data when heart rate is smaller than 30 or over 240, ibi is  time between heartbeats is 1000 ms - 60 beats/min
-        ibi = df_hr[(df_hr['hrIbi'] >= 25) & (df_hr['hrIbi'] <= 2000)]
+    # Both are in time order, join only the two compared columns on the time index
+    acc = df_acc.set_index(str_time)[[str_acc]]
+    hr = df_hr.set_index(str_time)[[str_HR]]
+    data = acc.join(hr, how='inner').dropna()
     
-        # Calculate HRV metrics in 10-minute interval
-        windowed_data = ibi.groupby(pd.Grouper(key=str_time, freq='10Min'))
-        df_hrv = pd.DataFrame(columns=[str_time, str_HRV1, str_HRV2, str_HRV3, str_HRV4])
-        for window_start, group in windowed_data:
-            hrv = calculate_hrv(group)        
-            if hrv is not None:
-                data = {str_time: [window_start], str_HRV1: [hrv[0]], str_HRV2: [hrv[1]], str_HRV3: [hrv[2]], str_HRV4: [hrv[3]]}
-                hrv_data = pd.DataFrame(data)            
-                df_hrv = pd.concat([df_hrv, hrv_data], ignore_index=True)
-                
-        df_hrv.to_csv(os.path.join(data_folder_p, hrv_file_name), index=False)
-        
-        print("Compare heart rate and acceleration ....\n")
-        # Correlation between ActiAC and heart rate
-        df_acc = pd.read_csv(os.path.join(data_folder_p, ac_file_name))
-        df_acc[str_time] = pd.to_datetime(df_acc[str_time])
-                
-        merged_df = pd.merge(df_acc, df_hr, on=str_time, how='inner')
-        
-        data = merged_df[[str_time, str_acc, str_HR]]
-        data.dropna(inplace=True)    
-        data = data.reset_index(drop=True)
-        
-        x = data[str_time]
-        scaler = MinMaxScaler()
-        y1 = scaler.fit_transform(data[[str_acc]])
-        y2 = scaler.fit_transform(data[[str_HR]])
-        
-        fig_folder_p = os.path.join(data_folder, patient_ID, fig_folder_path)
-        folderErrorHandling(fig_folder_p)
+    # Only positional arrays are used from here on, the time index is kept instead of being reset
+    x = data.index
+    acc_values, hr_values = data[str_acc].to_numpy(), data[str_HR].to_numpy()
+    # Normalized only for plotting, single precision is enough
+    y1 = min_max_scale(acc_values)
+    y2 = min_max_scale(hr_values)
+    
+    fig_folder_p = os.path.join(data_folder, patient_ID, fig_folder_path)
+    folderErrorHandling(fig_folder_p)
+
+    with plt.style.context('seaborn'):
+        scatter(x, y1, y2, str_acc, str_HR, plot_save=True, fig_folder=fig_folder_p)
+    
+    correlation = np.corrcoef(acc_values, hr_values)[0, 1]
+
 
-        with plt.style.context('seaborn'):
-            scatter(x, y1, y2, str_acc, str_HR, plot_save=True, fig_folder=fig_folder_p)
+def process_patient(patient_ID):
+    """Save heart rate and HRV metrics of one individual and plot heart rate against activity counts."""
+    input_folder_p = os.path.join(input_folder, patient_ID)
+    data_folder_p = os.path.join(data_folder, patient_ID)
+
+    df_hr = read_hr_folder(os.path.join(input_folder_p, hr_folder_path))
+    write_csv(df_hr, os.path.join(data_folder_p, hr_file_name))
         
-        correlation = data[str_acc].corr(data[str_HR])
+    # delete data when heart rate is smaller than 30 or over 240, ibi is  time between heartbeats is 1000 ms - 60 beats/min
+    # Only the times and RR intervals are needed, filter them as arrays instead of copying all columns
+    times = df_hr[str_time].to_numpy(dtype='datetime64[ns]')
+    nn_intervals = df_hr['hrIbi'].to_numpy(dtype=np.float64)
+    valid = (nn_intervals >= 25) & (nn_intervals <= 2000) & ~np.isnat(times)
+
+    # Calculate HRV metrics in 10-minute interval, all windows at once
+    hrv = calculate_hrv(times[valid], nn_intervals[valid])
+    df_hrv = pd.DataFrame(dict(zip([str_time, str_HRV1, str_HRV2, str_HRV3, str_HRV4], hrv)))
+            
+    write_csv(df_hrv, os.path.join(data_folder_p, hrv_file_name))
+    
+    # Compare heart rate and acceleration only when figures are wanted
+    if PLOT_FIGURE:
+        plot_hr_activity(df_hr, patient_ID)
+
+
+def main():
+    # Each individual is independent, process them in parallel, the workers only save figures
+    with ProcessPoolExecutor(initializer=headless) as executor:
+        list(executor.map(process_patient, patient_list))
 
     
 if __name__ == "__main__":
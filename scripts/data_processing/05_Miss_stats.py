@@ -78,19 +78,13 @@ all_miss_file = os.path.join(stats_folder, all_miss_path)
 
 def merge_miss():
     """Merge three types of miss files."""
-    # Read Acti miss file
-    acti_miss_df = pd.read_csv(acti_miss_file)  
+    # Read Acti, Watch and CORE miss files indexed by ID, only the non-wearing time of the watch is kept
+    acti_miss_df = pd.read_csv(acti_miss_file, index_col='ID')  
+    watch_miss_df = pd.read_csv(watch_miss_file, index_col='ID')[['Watch-No-Wear [%]']]
+    core_miss_df = pd.read_csv(core_miss_file, index_col='ID')  
     
-    # Read Watch miss file
-    watch_df = pd.read_csv(watch_miss_file)  
-    watch_miss_df = watch_df[['ID', 'Watch-No-Wear [%]']]
-    
-    # Check if the CORE miss file exists
-    core_miss_df = pd.read_csv(core_miss_file)  
-    
-    miss_df = pd.merge(pd.merge(acti_miss_df, watch_miss_df, on='ID'), core_miss_df, on='ID')
-    
-    miss_df = miss_df.drop(columns='ID')
+    # IDs are unique in each file, align the three on the ID index (IDs in all files) instead of merging twice
+    miss_df = pd.concat([acti_miss_df, watch_miss_df, core_miss_df], axis=1, join='inner')
 
     column_names = ['Actigraph', 'Smartwatch', 'CORE']
     miss_df.columns = column_names
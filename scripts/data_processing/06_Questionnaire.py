@@ -35,6 +35,7 @@ Output:
 """
 
 import pandas as pd
+import numpy as np
 from matplotlib import pyplot as plt
 import os
 import sys
@@ -79,18 +80,16 @@ def MEQ_calculation(folder):
     
     for idx in range(1,4):
         file_path = os.path.join(folder, 'Q'+ str(idx) +'.csv')
-        df = pd.read_csv(os.path.join(file_path))
-        
         points_columns = [f"Points.{i}" for i in range(1, 19)]  # Assuming columns are named "points1", "points2", ..., "points5"
         
-        MEQ = df[points_columns]
-        MEQ.insert(loc=0, column='Points.0', value=df['Points'])
-        MEQ.insert(loc=0, column='SUM', value= MEQ.sum(axis=1))
-        MEQ.insert(loc=0, column='ID', value= df['Participant ID'])
-    
-        MEQs.append(MEQ)
+        # Duplicated 'Points' headers are numbered by the parser, only the ID and points are read
+        df = pd.read_csv(file_path, usecols=['Participant ID', 'Points'] + points_columns)
+        
+        # Sum of the points, unanswered items count as 0
+        MEQ_sum = np.nansum(df[['Points'] + points_columns].to_numpy(), axis=1)
+        MEQs.append((df['Participant ID'], pd.Series(MEQ_sum, index=df.index)))
         
-    sum_MEQ = pd.DataFrame({'ID': MEQs[0]['ID'],'MEQ1': MEQs[0]['SUM'], 'MEQ2': MEQs[1]['SUM'], 'MEQ3': MEQs[2]['SUM']})
+    sum_MEQ = pd.DataFrame({'ID': MEQs[0][0], 'MEQ1': MEQs[0][1], 'MEQ2': MEQs[1][1], 'MEQ3': MEQs[2][1]})
     sum_MEQ['MEQ'] = sum_MEQ[['MEQ1', 'MEQ2', 'MEQ3']].mean(axis=1).round(2)
     
     return sum_MEQ
@@ -99,26 +98,27 @@ def MEQ_calculation(folder):
 def baseline_summary(df_baseline):
     """Keep relevant information from the baseline questionnaire."""
     
-    for col in df_baseline.columns:
-        if "birth year" in col.lower():
-            df_baseline[col] = pd.to_numeric(df_baseline[col], errors='coerce').astype('Int64')
-            df_baseline['Age'] = 2023 - df_baseline[col]
-            break  
+    birth_cols = df_baseline.columns[df_baseline.columns.str.contains("birth year", case=False, regex=False)]
+    if len(birth_cols):
+        df_baseline['Age'] = study_year - pd.to_numeric(df_baseline[birth_cols[0]], errors='coerce').astype('Int64')
         
     #df_baseline.iloc[:, 4] = df_baseline.iloc[:, 4].astype(int)
     #df_baseline['Age'] = study_year - df_baseline.iloc[:, 4] 
-    df_baseline['BMI'] = df_baseline['Weight (kg)'] / ((df_baseline['Height (cm)']/100) ** 2)
+    height = df_baseline['Height (cm)'].to_numpy() / 100
+    df_baseline['BMI'] = df_baseline['Weight (kg)'].to_numpy() / (height * height)
     adapt_names = {'Participant ID': 'ID', 'Biological sex': 'Gender', 'What is your main racial group?': 'Racial', 'Which of the following best describes your main work status over the past 12 months?': 'Job', 'If you are employed (or a student), how much hours do you work (study) per week?': 'Working hour'}
+    adapt_prefixes = {"Do you drink coffee, tea": "Coffee Binary", "How many of those do you consume on average on a daily basis? (Quantities are for approximate purposes only and do not have to be exact) Coffee": "Coffee Amount", "During the past 7 days": "Alcohol Amount"}
+    for col in df_baseline.columns:
+        new_name = next((name for start, name in adapt_prefixes.items() if col.startswith(start)), None)
+        if new_name is not None:
+            adapt_names[col] = new_name
     df_baseline = df_baseline.rename(columns=adapt_names)
     
-    df_baseline.rename(columns=lambda x: "Coffee Binary" if x.startswith("Do you drink coffee, tea") else x, inplace=True)
-    df_baseline.rename(columns=lambda x: "Coffee Amount" if x.startswith("How many of those do you consume on average on a daily basis? (Quantities are for approximate purposes only and do not have to be exact) Coffee") else x, inplace=True)
-    df_baseline.rename(columns=lambda x: "Alcohol Amount" if x.startswith("During the past 7 days") else x, inplace=True)
-    
     # Prefix to remove
     prefix = 'At least 1 row is required in this question type. = '
-    # Remove prefix from all columns
-    df_baseline = df_baseline.applymap(lambda x: x.replace(prefix, '') if isinstance(x, str) else x)
+    # Remove prefix from all text columns, non-string cells are kept as they are
+    for col in df_baseline.select_dtypes(include=['object', 'string']).columns:
+        df_baseline[col] = df_baseline[col].str.replace(prefix, '', regex=False).fillna(df_baseline[col])
     
     counts = df_baseline['Coffee Binary'].value_counts()
     for value, count in counts.items():
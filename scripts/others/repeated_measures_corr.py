@@ -27,13 +27,14 @@ This script calculates repeated measures correlation.
 import pandas as pd
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import pingouin as pg
 import seaborn as sns
 import matplotlib.pyplot as plt
 import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
-from utils.read_file import load_config
+from utils.read_file import load_config, list_patients
 
 
 ############### Define global parameters ###############
@@ -57,23 +58,23 @@ str_time, str_Acti, str_Watch = (
     ]
 )
 
-subfolders = [
-    f for f in os.listdir(input_folder)
-    if os.path.isdir(os.path.join(input_folder, f)) and f.isdigit()
-]
+patient_list = list_patients(input_folder)
 
-patient_list = sorted(subfolders, key=lambda x: int(x))
-
-df_rmc = pd.DataFrame()
-
-for patient_ID in patient_list:
+def read_patient(patient_ID):
+    """Read the activity counts of one individual."""
     print("="*30)
     print(patient_ID)   
-    df = pd.read_csv(os.path.join(input_folder, patient_ID, AC_file))
+    df = pd.read_csv(os.path.join(input_folder, patient_ID, AC_file), engine='pyarrow', usecols=[str_Watch, str_Acti])
     df['Subject'] = patient_ID
-    df_rmc = pd.concat([df_rmc, df])
+    return df
+
+# The files are read in threads, the script has no main guard for worker processes
+with ThreadPoolExecutor() as executor:
+    dfs = list(executor.map(read_patient, patient_list))
 
-df_rmc = df_rmc.reset_index()
+df_rmc = pd.concat(dfs, ignore_index=True)
+# Participants keep their order in the legend
+df_rmc['Subject'] = pd.Categorical(df_rmc['Subject'], categories=patient_list)
 df_rmc = df_rmc[['Subject', str_Watch, str_Acti]]
 
 rmc_result = pg.rm_corr(data=df_rmc, x=str_Watch, y=str_Acti, subject='Subject')
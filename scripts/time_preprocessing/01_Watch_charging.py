@@ -35,6 +35,7 @@ Output:
 """
 
 import pandas as pd
+import numpy as np
 import datetime
 from tqdm import tqdm
 import os
@@ -42,7 +43,7 @@ import sys
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 from matplotlib import pyplot as plt
-from utils.read_file import battery_csv, load_config
+from utils.read_file import battery_csv, load_config, write_cached
 from utils.error_handling import folderErrorHandling
 
 
@@ -88,9 +89,8 @@ increase_thres = 5 # 5 for old version
 
 def read_times(file_name, patient_ID):
     """Read start and end time in the study period."""
-    times= pd.read_csv(file_name)
-    start_str = times.loc[times['ID'] == int(patient_ID), 'Start'].iloc[0]
-    end_str = times.loc[times['ID'] == int(patient_ID), 'End'].iloc[0]
+    times = pd.read_csv(file_name, engine='pyarrow', usecols=['ID', 'Start', 'End'])
+    start_str, end_str = times.loc[times['ID'] == int(patient_ID), ['Start', 'End']].iloc[0]
     start_time = datetime.datetime.strptime(start_str, "%d.%m.%y %H:%M")
     end_time = datetime.datetime.strptime(end_str, "%d.%m.%y %H:%M")
     return start_time, end_time
@@ -98,20 +98,29 @@ def read_times(file_name, patient_ID):
 def find_charging_time(battery_folder, start_time, end_time): 
     """Find charging time fragments based on charging level and status."""
     file_names = os.listdir(battery_folder)
-    csv_names = [file_name for file_name in file_names if file_name.endswith('.csv')]
-    sorted_csv_names = sorted(csv_names, key=lambda x: datetime.datetime.strptime(x.rsplit('.', 1)[0], "%d.%m.%y_%H"), reverse=False)
+    csv_names = np.array([file_name for file_name in file_names if file_name.endswith('.csv')], dtype=object)
     
-    df_battery = pd.DataFrame()
+    # Parse the hour of all file names at once, keep the files in the study period in time order
+    timestamps = pd.to_datetime(pd.Index([file_name[:-4] for file_name in csv_names], dtype=object), format="%d.%m.%y_%H")
+    in_period = np.flatnonzero((timestamps >= start_time) & (timestamps < end_time))
+    sorted_csv_names = csv_names[in_period[np.argsort(timestamps[in_period], kind='stable')]]
+    
+    dfs = []
     for file in tqdm(sorted_csv_names):
-        timestamp = datetime.datetime.strptime(file, "%d.%m.%y_%H.csv")
-        if start_time <= timestamp < end_time:
-            file_path = os.path.join(battery_folder, file)
-            df = battery_csv(file_path)
-            if df is not None:
-                df_battery = pd.concat([df_battery, df])
-
-    increase_mask = (df_battery['state'].shift(1).isin([1,2])) & (df_battery['state'].isin([3, 4, 5, 6]))
-    decrease_mask = (df_battery['state'].shift(-1).isin([1,2])) & (df_battery['state'].isin([3, 4, 5, 6]))
+        file_path = os.path.join(battery_folder, file)
+        df = battery_csv(file_path)
+        if df is not None:
+            dfs.append(df)
+    df_battery = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+    # Charging states are 3-6, states 1-2 are not charging, compare each row with its neighbours on the raw array
+    state = df_battery['state'].to_numpy()
+    not_charging = (state >= 1) & (state <= 2)
+    charging = (state >= 3) & (state <= 6)
+    increase_mask = np.zeros(len(state), dtype=bool)
+    increase_mask[1:] = not_charging[:-1] & charging[1:]
+    decrease_mask = np.zeros(len(state), dtype=bool)
+    decrease_mask[:-1] = not_charging[1:] & charging[:-1]
 
     increase_datetime = df_battery.loc[increase_mask, 'time']
     charge_starttime = increase_datetime - datetime.timedelta(minutes=2)
@@ -148,45 +157,58 @@ def charging_timev1(battery_folder, start_time, end_time):
     return df_battery, start_times, end_times
 
 
+def prefix_sums(values):
+    """Cumulative sums with a leading 0, so that sum(values[a:b]) = cumsum[b] - cumsum[a]."""
+    return np.concatenate(([0], np.cumsum(values)))
+
+
+def window_sums(cumsum, offset, width, n_windows):
+    """Sums of values[i + offset : i + offset + width] for the windows i = 0 .. n_windows - 1."""
+    starts = np.arange(n_windows) + offset
+    return cumsum[starts + width] - cumsum[starts]
+
+
+def nonoverlapping_starts(mask, step):
+    """Indices where the mask holds, skipping the following step - 1 indices after each match."""
+    starts = []
+    next_start = 0
+    for i in np.flatnonzero(mask):
+        if i >= next_start:
+            starts.append(i)
+            next_start = i + step
+    return starts
+
+
 def charging_timev2(df_battery, start_time, end_time):
     """Second method to look for charging time based on differences between charging levels in the moving window."""
     df_battery.reset_index(drop=True, inplace=True)
     df_battery['time'] = pd.to_datetime(df_battery['time'])
     
+    # Windows start at 0 .. n_windows - 1, the differences of window i are level_diff[i : i + window_size - 1]
+    n_windows = max(len(df_battery) - window_size, 0)
+    level_diff = np.diff(df_battery['level'].to_numpy(dtype=np.float64))
+    state = df_battery['state'].to_numpy(dtype=np.float64)
+    
+    # Sums of the first half without the leading NaN and of the second half, missing levels count as 0
+    # Both patterns share one cumulative sum of the differences
+    level_cumsum = prefix_sums(np.nan_to_num(level_diff))
+    first_sum = window_sums(level_cumsum, 0, half_window - 1, n_windows)
+    second_sum = window_sums(level_cumsum, half_window - 1, window_size - half_window, n_windows)
+    first_rises = window_sums(prefix_sums(level_diff > 0), 0, half_window - 1, n_windows)
+    
     # Check if the 'level' values in the window first decrease and then increase
-    charge_start_time = None  
-    end_times2 = []
-    i = 0
-    while i < len(df_battery) - window_size:
-        current_window = df_battery.iloc[i : i + window_size]  
-        level_diff = current_window['level'].diff()  # Calculate the differences between consecutive 'level' values
-        if level_diff[:half_window].all() <= 0 and level_diff[half_window:].sum() > increase_thres:
-            charge_start_time = current_window['time'].iloc[0]
-            end_times2.append(charge_start_time - datetime.timedelta(minutes=buffer_minute))
-            i = i + window_size
-        else:
-            i = i + 1
+    decrease_increase = (first_rises == 0) & (second_sum > increase_thres)
+    starts = nonoverlapping_starts(decrease_increase, window_size)
+    end_times2 = (df_battery['time'].iloc[starts] - datetime.timedelta(minutes=buffer_minute)).tolist()
     end_times2.append(end_time) 
     
-    # Check if the 'level' values in the window first increase and then decrease
-    charge_end_time = None  
-    start_times2 = []
-    start_times2.append(start_time)
-    i = 0
-    while i < len(df_battery) - window_size:
-        current_window = df_battery.iloc[i : i + window_size] 
-        level_diff = current_window['level'].diff()  # Calculate the differences between consecutive 'level' values
-        statuses = current_window['state']
-        if level_diff[:half_window].sum() > 5 and level_diff[half_window:].sum() <= -1:
-            charge_end_time = current_window['time'].iloc[-1]
-            start_times2.append(charge_end_time + datetime.timedelta(minutes=buffer_minute))
-            i = i + window_size
-        elif (statuses[:half_window] > 2).all() & (statuses[half_window+1:window_size+1] <= 2).all():
-            charge_end_time = current_window['time'].iloc[-1]
-            start_times2.append(charge_end_time + datetime.timedelta(minutes=buffer_minute)) 
-            i = i + window_size
-        else:
-            i = i + 1       
+    # Check if the 'level' values in the window first increase and then decrease, or the status leaves charging
+    increase_decrease = (first_sum > 5) & (second_sum <= -1)
+    n_after = window_size - half_window - 1
+    charging_ends = (window_sums(prefix_sums(state > 2), 0, half_window, n_windows) == half_window) & (window_sums(prefix_sums(state <= 2), half_window + 1, n_after, n_windows) == n_after)
+    starts = nonoverlapping_starts(increase_decrease | charging_ends, window_size)
+    start_times2 = [start_time]
+    start_times2.extend((df_battery['time'].iloc[np.asarray(starts, dtype=np.intp) + window_size - 1] + datetime.timedelta(minutes=buffer_minute)).tolist())
 
     return start_times2, end_times2
 
@@ -233,7 +255,7 @@ def main():
     
     miss_battery = pd.DataFrame({'Start': start_times2, 'End': end_times2})
             
-    miss_battery.to_csv(main_output, index=False)
+    write_cached(miss_battery, main_output)
     
 
 if __name__ == "__main__":
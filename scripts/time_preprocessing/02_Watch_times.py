@@ -39,11 +39,13 @@ Output:
 import os
 import datetime
 import pandas as pd
+import numpy as np
 import sys
+from concurrent.futures import ProcessPoolExecutor
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 from utils.error_handling import folderErrorHandling
-from utils.read_file import load_config
+from utils.read_file import load_config, list_patients, cached_read, write_cached
 
 ############### Define global parameters ###############
 # Load configuration and define variables
@@ -67,122 +69,77 @@ output_root, output_path, acc_times_file, hr_times_file = (
 )
 output_folder = os.path.join(output_root, output_path)
 
-subfolders = [
-    f for f in os.listdir(input_folder)
-    if os.path.isdir(os.path.join(input_folder, f)) and f.isdigit()
-]
-
-patient_list = sorted(subfolders, key=lambda x: int(x))
+patient_list = list_patients(input_folder)
 
 
 def files_miss(start_time, end_time, folder):
     """Find the specific hours when file was not recorded within the whole 2-week study period"""
-    expected_files = []
-    current_time = start_time
-    while current_time < end_time:
-        file_name = current_time.strftime('%d.%m.%y_%H') + '.csv'
-        expected_files.append(file_name)
-        current_time += datetime.timedelta(hours=1)
-
-    # Get the list of files in the folder
-    files = os.listdir(folder)
-    missing_files = set(expected_files) - set(files)
-    missing_files = sorted(list(missing_files), key=lambda x: datetime.datetime.strptime(x[:-4], "%d.%m.%y_%H"))
-    return missing_files
+    # Every hour touched by start_time + k hours before end_time is expected to have a file
+    n_hours = max(-(-(end_time - start_time) // datetime.timedelta(hours=1)), 0)
+    expected_hours = np.datetime64(start_time, 'h') + np.arange(n_hours)
+
+    # Hours of the files in the folder, names are e.g. 01.06.23_10.csv
+    file_names = [file_name[:-4] for file_name in os.listdir(folder) if len(file_name) == 15 and file_name.endswith('.csv')]
+    file_hours = pd.to_datetime(pd.Index(file_names, dtype=object), format="%d.%m.%y_%H", errors='coerce').to_numpy().astype('datetime64[h]')
+    return np.setdiff1d(expected_hours, file_hours)
 
 def read_times(time_file):
     """Read each pair of start and end wearing time"""
-    times= pd.read_csv(time_file)  
-    times['Start'] = pd.to_datetime(times['Start'])
-    times['End'] = pd.to_datetime(times['End'])
-    
-    start_times = pd.to_datetime(times['Start'])
-    end_times = pd.to_datetime(times['End'])
-    return start_times, end_times
+    times = cached_read(time_file, parse_dates=['Start', 'End'])
+    return times['Start'], times['End']
 
 def files_to_time(missing_files):
     """Identifies consecutive files with hour sequences and merges them into time intervals where no files were found."""
-    nofile_starts = []
-    nofile_ends = []
-    current_start = None
-    previous_datetime = None
-    
-    for file in missing_files:
-        datetime_str = file[:-4]  # Remove the ".csv" extension
-        current_datetime = datetime.datetime.strptime(datetime_str, "%d.%m.%y_%H")
-        if previous_datetime and current_datetime - previous_datetime > datetime.timedelta(hours=1):
-            if current_start:
-                if current_start == previous_datetime.strftime("%d.%m.%y_%H"):
-                    tmp = datetime.datetime.strptime(current_start, "%d.%m.%y_%H")
-                    nofile_starts.append(tmp)
-                    nofile_ends.append(tmp+pd.Timedelta(hours=1))
-                else:
-                    nofile_starts.append(datetime.datetime.strptime(current_start, "%d.%m.%y_%H"))
-                    nofile_ends.append(previous_datetime+pd.Timedelta(hours=1))
-            current_start = None
-    
-        if not current_start:
-            current_start = current_datetime.strftime('%d.%m.%y_%H')
+    if len(missing_files) == 0:
+        return [], []
     
-        previous_datetime = current_datetime
+    # A run of consecutive hours ends wherever the next missing hour is not one hour later
+    gaps = np.flatnonzero(np.diff(missing_files) != np.timedelta64(1, 'h'))
+    run_starts = missing_files[np.concatenate(([0], gaps + 1))]
+    run_ends = missing_files[np.concatenate((gaps, [len(missing_files) - 1]))] + np.timedelta64(1, 'h')
     
-    if current_start:
-        if current_start == previous_datetime.strftime("%d.%m.%y_%H"):
-            tmp = datetime.datetime.strptime(current_start, "%d.%m.%y_%H")
-            nofile_starts.append(tmp)
-            nofile_ends.append(tmp+pd.Timedelta(hours=1))
-            
-        else:
-            nofile_starts.append(datetime.datetime.strptime(current_start, "%d.%m.%y_%H"))
-            nofile_ends.append(previous_datetime+pd.Timedelta(hours=1))
+    nofile_starts = run_starts.astype('datetime64[us]').tolist()
+    nofile_ends = run_ends.astype('datetime64[us]').tolist()
     return nofile_starts, nofile_ends
 
 
 
 def combine_battery_nofile(start_times, end_times, nofile_starts, nofile_ends):
     """combine and merge the times with battery miss and times when no file was recorded."""
-    combined_starts = pd.concat([start_times, pd.Series(nofile_ends)])
-    combined_starts = combined_starts.sort_values()
-    combined_starts = combined_starts.reset_index(drop=True)
-    
-    combined_ends = pd.concat([end_times, pd.Series(nofile_starts)])
-    combined_ends = combined_ends.sort_values()
-    combined_ends = combined_ends.reset_index(drop=True)
-    
-    problem_indices = []
-        
-    # Check if each item in endtime is later than the corresponding starttime
-    for i, _ in enumerate(combined_starts):
-        if not combined_starts.iloc[i] < combined_ends.iloc[i]:
-            #print("Battery charging time has problem", i, "*start*", combined_starts.iloc[i], "*end*", combined_ends.iloc[i])
-            problem_indices.append(i)
+    # Hours without files end a wearing time at their start and start the next one at their end
+    combined_starts = np.sort(np.concatenate([start_times.to_numpy(), np.asarray(nofile_ends, dtype='datetime64[ns]')]))
+    combined_ends = np.sort(np.concatenate([end_times.to_numpy(), np.asarray(nofile_starts, dtype='datetime64[ns]')]))
     
-    combined_starts.drop(problem_indices, inplace=True)
-    combined_ends.drop(problem_indices, inplace=True)
+    # Keep only the pairs where the end time is later than the start time
+    valid = combined_starts < combined_ends
     
-    combined_times = pd.DataFrame({'Start': combined_starts, 'End': combined_ends})
-    combined_times = combined_times.reset_index(drop=True)
+    combined_times = pd.DataFrame({'Start': combined_starts[valid], 'End': combined_ends[valid]})
     return combined_times
     
 
-def main():
-    for patient_ID in patient_list:
+def process_patient(patient_ID):
+    """Save the valid wearing times of the accelerometer and heart rate for one individual."""
+    input_folder_p = os.path.join(input_folder, patient_ID)    
+    output_folder_p = os.path.join(output_folder, patient_ID)
+    folderErrorHandling(output_folder_p)
 
-        input_folder_p = os.path.join(input_folder, patient_ID)    
-        output_folder_p = os.path.join(output_folder, patient_ID)
-        folderErrorHandling(output_folder_p)
+    start_times, end_times = read_times(os.path.join(output_folder_p, battery_file_name))
     
-        start_times, end_times = read_times(os.path.join(output_folder_p, battery_file_name))
-        
-        for subfolder_path, output_str in zip([acc_folder, hr_folder], [acc_times_file, hr_times_file]):
+    for subfolder_path, output_str in zip([acc_folder, hr_folder], [acc_times_file, hr_times_file]):
+    
+        missing_files = files_miss(start_times.iloc[0], end_times.iloc[-1], os.path.join(input_folder_p, subfolder_path))
         
-            missing_files = files_miss(start_times.iloc[0], end_times.iloc[-1], os.path.join(input_folder_p, subfolder_path))
-            
-            nofile_starts, nofile_ends = files_to_time(missing_files)
-            
-            combined_times = combine_battery_nofile(start_times, end_times, nofile_starts, nofile_ends)
+        nofile_starts, nofile_ends = files_to_time(missing_files)
         
-            combined_times.to_csv(os.path.join(output_folder_p, output_str), index=False)
+        combined_times = combine_battery_nofile(start_times, end_times, nofile_starts, nofile_ends)
+    
+        write_cached(combined_times, os.path.join(output_folder_p, output_str))
+
+
+def main():
+    # Each individual is independent, process them in parallel
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(process_patient, patient_list))
             
 
 
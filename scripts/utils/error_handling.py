@@ -43,9 +43,15 @@ def inputErrorHandling(indicator, condition='empty'):
         print("Invalid input:", e)
 
 
+
+# Folders already checked or created in this process
+_checked_folders = set()
         
 def folderErrorHandling(folder_path):
     """Check if the folder exists, if not, create it"""
+    folder_path = os.path.abspath(folder_path)
+    if folder_path in _checked_folders:
+        return
     try:
         # Check if the folder exists
         if os.path.exists(folder_path):
@@ -54,6 +60,7 @@ def folderErrorHandling(folder_path):
         else:
             os.makedirs(folder_path)
             print(f"Folder '{folder_path}' created successfully.")
+        _checked_folders.add(folder_path)
     except Exception as e:
         print("An error occurred:", e)
 
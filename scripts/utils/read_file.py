@@ -28,15 +28,21 @@ This script include several functions to read different files.
 import pandas as pd
 import matplotlib.pyplot as plt
 import datetime
-import csv
 from datetime import timedelta
 import os
 import numpy as np
 import json
+from functools import lru_cache
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads reading the files of one folder, the folders are already read in one process per participant or timeslot
+FOLDER_READ_THREADS = 4
+
 
 def check_both_zero(df_subset, str1, str2):
     """Return true if both are non zero."""
-    return df_subset[str1].eq(0).all() and df_subset[str2].eq(0).all()
+    return not df_subset[str1].to_numpy().any() and not df_subset[str2].to_numpy().any()
 
 
 def parse_datetime(datetime_str):
@@ -50,11 +56,20 @@ def parse_datetime(datetime_str):
     return dttime 
 
 
+def parse_datetime_column(datetime_strs):
+    """Parse a column of datetime strings at once, strings without time (no match of "%Y-%m-%d %H:%M:%S") are parsed at 00:00:00 as in parse_datetime."""
+    dttimes = pd.to_datetime(datetime_strs, format="%Y-%m-%d %H:%M:%S", errors='coerce')
+    date_only = dttimes.isna() & datetime_strs.notna()
+    if date_only.any():
+        dttimes[date_only] = pd.to_datetime(datetime_strs[date_only] + ' 00:00:00')
+    return dttimes
+
+
 def sleep_csv(file):
     """Read sleep time."""
     sleep_times= pd.read_csv(file)  
-    sleep_start = sleep_times['in_bed_time'].apply(parse_datetime)
-    sleep_end = sleep_times['out_bed_time'].apply(parse_datetime)
+    sleep_start = parse_datetime_column(sleep_times['in_bed_time'])
+    sleep_end = parse_datetime_column(sleep_times['out_bed_time'])
     
     return sleep_start, sleep_end
 
@@ -62,24 +77,23 @@ def sleep_csv(file):
 
 def acc_csv(file_path, start_time, end_time):
     """Read Activity counts from Actigraph file within defined timeframe."""
-    df = pd.read_csv(file_path)
+    # Only the columns which are kept, the names may contain spaces
+    df = pd.read_csv(file_path, usecols=lambda col: col.replace(' ', '') in {'Date', 'Time', 'Axis1', 'Axis2', 'Axis3', 'VectorMagnitude'})
     df.columns = df.columns.str.replace(' ', '')
     
-    for index, row in df.iterrows():
-        try:
-            parsed_date = datetime.datetime.strptime(row['Date'], "%m.%d.%y")
-            converted_date = parsed_date.strftime("%m/%d/%Y")
-            df.loc[index, 'Date'] = converted_date
-        except ValueError:
-            continue
+    # Dates written as 06.01.23 are converted to 06/01/2023, other dates are kept
+    parsed_date = pd.to_datetime(df['Date'], format="%m.%d.%y", errors='coerce')
+    df['Date'] = parsed_date.dt.strftime("%m/%d/%Y").where(parsed_date.notna(), df['Date'])
     
-    df['time'] = pd.to_datetime(df['Date'] + ' ' + df['Time'])
+    # Parse with the explicit format, only dates in other formats fall back to format inference
+    time_str = df['Date'] + ' ' + df['Time']
+    df['time'] = pd.to_datetime(time_str, format="%m/%d/%Y %H:%M:%S", errors='coerce')
+    unparsed = df['time'].isna()
+    if unparsed.any():
+        df.loc[unparsed, 'time'] = pd.to_datetime(time_str[unparsed])
     
-    # exchange values in Axis 1 and Axis 2
-    df['tmp'] = df['Axis1']
-    df['Axis1'] = df['Axis2']
-    df['Axis2'] = df['tmp']
-    df['AC'] = df['VectorMagnitude']
+    # exchange values in Axis 1 and Axis 2, by renaming without copying the columns
+    df = df.rename(columns={'Axis1': 'Axis2', 'Axis2': 'Axis1', 'VectorMagnitude': 'AC'})
 
     df = df[['time', 'Axis1', 'Axis2', 'Axis3', 'AC']]
     
@@ -89,14 +103,48 @@ def acc_csv(file_path, start_time, end_time):
 
 
 
-def acc_watch_csv(file_path):  
-    """Read each raw acceleration file from smartwatch file."""
-    df = pd.read_csv(file_path, on_bad_lines='skip')
+def _local_utc_offset(unix_ms):
+    """Offset of the local time zone from UTC at the given Unix time in milliseconds."""
+    seconds = unix_ms / 1000
+    return datetime.datetime.fromtimestamp(seconds) - datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).replace(tzinfo=None)
+
+
+def unix_ms_to_local(unix_ms):
+    """Convert Unix times in milliseconds to naive local datetimes, as datetime.fromtimestamp does, NaN becomes NaT."""
+    valid = unix_ms.dropna()
+    if valid.empty:
+        return pd.to_datetime(unix_ms, unit='ms')
+    
+    # The offset is added to the whole column unless the local offset changes (e.g., daylight saving time) within the data
+    offset = _local_utc_offset(valid.min())
+    if offset == _local_utc_offset(valid.max()):
+        return pd.to_datetime(unix_ms, unit='ms') + offset
+    return pd.to_datetime(unix_ms.apply(lambda x: datetime.datetime.fromtimestamp(x/1000) if pd.notnull(x) else x))
+
+
+def numeric_csv(file_path, dtype=None, **kwargs):
+    """Read a csv file of numeric columns, the parser sets the dtypes and only columns with invalid values are coerced (invalid values become NaN)."""
+    dtype = dtype or {}
+    try:
+        df = pd.read_csv(file_path, dtype=dtype, **kwargs)
+    except ValueError:
+        # A column of dtype has values which are not numbers
+        df = pd.read_csv(file_path, **kwargs)
+    
+    dirty_cols = df.select_dtypes(exclude='number').columns
+    if len(dirty_cols):
+        df[dirty_cols] = df[dirty_cols].apply(pd.to_numeric, errors='coerce')
+    return df.astype({col: col_type for col, col_type in dtype.items() if col in df.columns})
+
+
+def acc_watch_csv(file_path, window_start=None, window_end=None):  
+    """Read each raw acceleration file from smartwatch file, only upsample the part within [window_start, window_end) if given."""
+    # Raw counts divided by 4096 are exact in float32
+    df = numeric_csv(file_path, dtype={'x': 'float32', 'y': 'float32', 'z': 'float32'}, on_bad_lines='skip')
     
     # delete bad lines
     df = df[df['UnixTimestamp'].notna()]
-    df = df.apply(pd.to_numeric, errors='coerce')
-    df['time'] = df['UnixTimestamp'].apply(lambda x: datetime.datetime.fromtimestamp(x/1000) if pd.notnull(x) else x)
+    df['time'] = unix_ms_to_local(df['UnixTimestamp'])
     df.dropna(subset=['time'], inplace=True)
     
     # If DataFrame has less than 50 rows, skip
@@ -109,61 +157,71 @@ def acc_watch_csv(file_path):
     df = df.drop(df[~df['time'].between(start_time, end_time)].index)
     
     df = df.reset_index(drop=True)
-
-    df['time'] = pd.to_datetime(df['time'])
     
     # Adapt the acceleration unit to mG
     df['X'], df['Y'], df['Z'] = df['x']/4096, df['y']/4096, df['z']/4096
     df = df[['time', 'X', 'Y', 'Z']]
     
-    # Upsample data from 25Hz to 50Hz 
-    rounded_start_time = df['time'].min().floor('T')
-    rounded_end_time = df['time'].max().ceil('T')
-    idx = pd.date_range(start=rounded_start_time, end=rounded_end_time, freq="20ms", inclusive='left')
-    
     df = df.set_index('time')
     df = df.loc[~df.index.duplicated(), :]
     df.index = df.index.sort_values()
     
-    mapped_df = df.reindex(idx, method='nearest')
-    mapped_df = mapped_df.reset_index()
-    mapped_df = mapped_df.rename(columns={"index": "time"})
+    # Keep the samples within the window and their neighbours outside of it, the nearest sample of each grid point is unchanged
+    if window_start is not None:
+        first = max(df.index.searchsorted(window_start) - 1, 0)
+        df = df.iloc[first:df.index.searchsorted(window_end) + 1]
+    
+    # Upsample data from 25Hz to 50Hz 
+    rounded_start_time = df.index[0].floor('T')
+    rounded_end_time = df.index[-1].ceil('T')
+    idx = pd.date_range(start=rounded_start_time, end=rounded_end_time, freq="20ms", inclusive='left')
+    if window_start is not None:
+        idx = idx[idx.searchsorted(window_start):idx.searchsorted(window_end)]
+    
+    # Nearest sample of each grid point, ties go to the later sample as in reindex(method='nearest')
+    src_ns, tgt_ns = df.index.asi8, idx.asi8
+    right = np.minimum(np.searchsorted(src_ns, tgt_ns), len(src_ns) - 1)
+    left = np.maximum(right - 1, 0)
+    nearest = np.where(tgt_ns - src_ns[left] < src_ns[right] - tgt_ns, left, right)
+    
+    mapped_df = df.iloc[nearest].reset_index(drop=True)
+    mapped_df.insert(0, 'time', idx)
 
     return mapped_df
     
 
+def _read_acc_file(file_path, window_start, window_end):
+    """Read one acceleration file within the window, None if it is too short or cannot be read."""
+    try:
+        return acc_watch_csv(file_path, window_start, window_end)
+    except Exception as e:
+        print(file_path)
+        print("An exception occurred in read_samsung_csv:", e)
+        return None
+
+
 def read_watch_acc_folder(folder_path, start_time, end_time):
     """List and read all related acceleration files and combine as one dataframe."""
-    file_names = os.listdir(folder_path)
-    csv_names = [file_name for file_name in file_names if file_name.endswith('.csv')]
-    sorted_csv_names = sorted(csv_names, key=lambda x: datetime.datetime.strptime(x.rsplit('.', 1)[0], "%d.%m.%y_%H"), reverse=False)
+    with os.scandir(folder_path) as entries:
+        csv_entries = [entry for entry in entries if entry.name.endswith('.csv')]
     
-    df_samsung = pd.DataFrame()
-    for file in sorted_csv_names:
-        timestamp = datetime.datetime.strptime(file, "%d.%m.%y_%H.csv")
-        if start_time - timedelta(hours=1) < timestamp < end_time:
-            file_path = os.path.join(folder_path, file)
-            try:
-                df = acc_watch_csv(file_path)
-                df_samsung = pd.concat([df_samsung, df])
-            except Exception as e:
-                print(file_path)
-                print("An exception occurred in read_samsung_csv:", e)
-                continue
-        elif timestamp > end_time:
-            break
-    filtered_df = df_samsung[(df_samsung['time'] >= start_time) & (df_samsung['time'] < end_time)]
-    return filtered_df
+    # Parse the hour of each file name once, then sort and select the files by it
+    timestamps = [datetime.datetime.strptime(entry.name.rsplit('.', 1)[0], "%d.%m.%y_%H") for entry in csv_entries]
+    order = sorted(range(len(csv_entries)), key=timestamps.__getitem__)
+    file_paths = [csv_entries[i].path for i in order if start_time - timedelta(hours=1) < timestamps[i] < end_time]
+    
+    # Files are read concurrently, pandas releases the GIL while parsing, map keeps the time order
+    with ThreadPoolExecutor(max_workers=FOLDER_READ_THREADS) as executor:
+        dfs = [df for df in executor.map(_read_acc_file, file_paths, repeat(start_time), repeat(end_time)) if df is not None]
+    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
 
 
 def hr_csv(file_path):
     """Read each valid heart rate data and RR interval data."""
     try:
-        df = pd.read_csv(file_path)
+        df = numeric_csv(file_path)
         df = df[df['UnixTimestamp'].notna()]
-        df = df.apply(pd.to_numeric, errors='coerce')
-        df['time'] = df['UnixTimestamp'].apply(lambda x: datetime.datetime.fromtimestamp(x/1000) if pd.notnull(x) else x)
-        df['time'] = pd.to_datetime(df['time'])
+        df['time'] = unix_ms_to_local(df['UnixTimestamp'])
         
         if len(df) < 50:
             return
@@ -179,25 +237,31 @@ def hr_csv(file_path):
         df = df[['time', 'hr', 'hrIbi']]
         df = df.dropna(subset=['hr'])
 
-        df['time'] = df['time'].apply(lambda dt: dt.replace(microsecond=0))
+        df['time'] = df['time'].dt.floor('s')
         return df
     except Exception as e:
         print(e)
         print(file_path)
 
 
+def _read_hr_file(file_path):
+    """Read one heart rate file, None if it cannot be parsed."""
+    try:
+        return hr_csv(file_path)
+    except pd.errors.ParserError:
+        print(f"Error parsing file: {file_path}. Skipping the file.")
+        return None
+
+
 def read_hr_folder(folder_path):
     """List and read all related heart rate files and combine as one dataframe."""
-    csv_files = sorted([file for file in os.listdir(folder_path) if file.endswith('.csv')])
-    df_hr = pd.DataFrame()
-    for file in csv_files:
-        file_path = os.path.join(folder_path, file)
-        try:
-            df = hr_csv(file_path)            
-            df_hr = pd.concat([df_hr, df], ignore_index=True)
-
-        except pd.errors.ParserError:
-            print(f"Error parsing file: {file_path}. Skipping the file.")
+    with os.scandir(folder_path) as entries:
+        file_paths = [entry.path for entry in sorted(entries, key=lambda entry: entry.name) if entry.name.endswith('.csv')]
+    
+    # Files are read concurrently, map keeps the order of the files
+    with ThreadPoolExecutor(max_workers=FOLDER_READ_THREADS) as executor:
+        dfs = [df for df in executor.map(_read_hr_file, file_paths) if df is not None]
+    df_hr = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
     df_hr = df_hr.rename(columns={'hr': 'HR'})
     return df_hr
 
@@ -205,13 +269,14 @@ def read_hr_folder(folder_path):
 def battery_csv(file_path):
     """Read each battery file."""
     try:
-        df = pd.read_csv(file_path)
+        df = numeric_csv(file_path)
         df = df[df['UnixTimestamp'].notna()]
-        df = df.apply(pd.to_numeric, errors='coerce')
-        df['time'] = df['UnixTimestamp'].apply(lambda x: datetime.datetime.fromtimestamp(x/1000) if pd.notnull(x) else x)
+        # Battery level (0-100) and charging state fit in one byte when no value is missing
+        df['level'] = pd.to_numeric(df['level'], downcast='unsigned')
+        df['state'] = pd.to_numeric(df['state'], downcast='integer')
+        df['time'] = unix_ms_to_local(df['UnixTimestamp'])
         df.dropna(subset=['time'], inplace=True)
         df = df.reset_index(drop=True)
-        df['time'] = pd.to_datetime(df['time'])
         return df
     except pd.errors.EmptyDataError:
        print (file_path, " is empty")
@@ -233,21 +298,19 @@ def core_csv(path, times, patient_ID):
     deli = times.loc[times['ID'] == int(patient_ID), 'Delimiter'].iloc[0]
     time_format = times.loc[times['ID'] == int(patient_ID), 'Timeformat'].iloc[0]    
 
-    with open(path, newline='') as csvfile:
-        reader = csv.reader(csvfile, delimiter=deli)
-        first_row = next(reader)
-        if any("SEP" in s for s in first_row):
-            df = pd.read_csv(path, sep=deli, skiprows=1)
-        else:
-            df = pd.read_csv(path, sep=deli)
+    # Skip the separator line of the export if there is one, and parse from the same handle
+    with open(path, 'rb') as csvfile:
+        first_line = csvfile.readline()
+        if b'SEP' not in first_line:
+            csvfile.seek(0)
+        df = pd.read_csv(csvfile, sep=deli)
 
+    # Both formats are kept at minute resolution
     if time_format == 1:
-        df['DateTime'] = df['DateTime'].apply(lambda x: datetime.datetime.strptime(x, '%d.%m.%Y %H:%M:%S').strftime('%Y-%m-%d %H:%M'))
-        df['DateTime'] = pd.to_datetime(df['DateTime'])
+        df['DateTime'] = pd.to_datetime(df['DateTime'], format='%d.%m.%Y %H:%M:%S').dt.floor('min')
 
     if time_format == 2:
         df['DateTime'] = pd.to_datetime(df['DateTime'], format='%d.%m.%y %H:%M')
-        df['DateTime'] = df['DateTime'].dt.strftime('%Y-%m-%d %H:%M')
 
 
     df['CBT'] = df['CoreBodyTemp [C]']
@@ -267,13 +330,60 @@ def core_csv(path, times, patient_ID):
 
 
 
-def load_config(current_dir):
-    """Load parameters defined in the config file."""
-    config_path = os.path.join(current_dir, '..', 'config.json')
+def _feather_path(path):
+    """Path of the Feather copy kept next to a csv file."""
+    return os.path.splitext(path)[0] + '.feather'
+
+
+def cached_read(path, categorical=(), downcast=False, parse_dates=()):
+    """Read a csv file, reuse its Feather copy as long as the copy is newer than the csv file, optionally downcast floats to float32."""
+    cache_path = _feather_path(path)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) > os.path.getmtime(path):
+        df = pd.read_feather(cache_path)
+    else:
+        # Parsed dates are stored as timestamps in the Feather copy and are not parsed again
+        df = pd.read_csv(path, parse_dates=list(parse_dates))
+        df = df.astype({col: 'category' for col in categorical})
+        df.to_feather(cache_path, compression='zstd')
+    
+    # The cached copy keeps full precision, callers may share it with different downcast settings
+    if downcast:
+        df = df.astype({col: 'float32' for col in df.select_dtypes('float64').columns})
+    return df
+
+
+def write_cached(df, path):
+    """Write a DataFrame as csv together with its Feather copy, so that cached_read does not parse the csv file."""
+    df.to_csv(path, index=False)
+    # Written after the csv file, the copy is newer and is reused by cached_read
+    df.reset_index(drop=True).to_feather(_feather_path(path), compression='zstd')
+
+
+def list_patients(folder):
+    """List participant folders (named with digits only) in numerical order."""
+    with os.scandir(folder) as entries:
+        return sorted((entry.name for entry in entries if entry.is_dir() and entry.name.isdigit()), key=int)
+
+
+def write_csv(df, path, compresslevel=1):
+    """Write a DataFrame (without index) in the pandas csv format, gzip compressed with a fast level if the path ends with .gz."""
+    compression = {'method': 'gzip', 'compresslevel': compresslevel} if path.endswith('.gz') else None
+    df.to_csv(path, index=False, compression=compression)
+
+
+@lru_cache(maxsize=None)
+def _read_config(config_path, mtime):
+    """Parse the config file, cached per path and modification time."""
     with open(config_path) as f:
         return json.load(f)
 
 
+def load_config(current_dir):
+    """Load parameters defined in the config file, the file is parsed once per process unless it changes."""
+    config_path = os.path.abspath(os.path.join(current_dir, '..', 'config.json'))
+    return dict(_read_config(config_path, os.path.getmtime(config_path)))
+
+
 
 
 
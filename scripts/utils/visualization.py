@@ -30,21 +30,54 @@ from matplotlib import pyplot as plt
 import os
 from scipy.stats import pearsonr
 import scipy.stats as stats
-from sklearn.linear_model import LinearRegression
 import matplotlib.dates as mdates
 
 
+def headless():
+    """Switch to the non-interactive backend, used in worker processes which only save figures."""
+    plt.switch_backend('Agg')
+
+
+def show_figures():
+    """Return True if figures are shown interactively (environment variable SHOW_FIGURE set), otherwise switch to the non-interactive backend."""
+    if os.environ.get("SHOW_FIGURE"):
+        return True
+    headless()
+    return False
+
+
+# Figure reused by the plots of a process, cleared for each plot instead of constructing a new one
+_fig = None
+
+
 def plot_style():
     """Transparent background"""
-    fig, ax = plt.subplots()
+    global _fig
+    if _fig is None or not plt.fignum_exists(_fig.number):
+        _fig = plt.figure()
+    else:
+        # Make it the current figure for the pyplot calls, with the figure colors of the current style
+        plt.figure(_fig.number)
+        _fig.clf()
+        _fig.set_facecolor(plt.rcParams['figure.facecolor'])
+        _fig.set_edgecolor(plt.rcParams['figure.edgecolor'])
+    fig = _fig
+    ax = fig.add_subplot()
     ax.set_facecolor('none') 
     fig.set_size_inches(4, 3)
     return fig, ax
 
+def valid_values(values):
+    """Float64 array of the values without NaN, as pandas reductions skip them."""
+    values = np.asarray(values, dtype=np.float64)
+    return values[~np.isnan(values)]
+
+
 def stas_diff(y1, y2):
     """Calculate difference of y1 and y2"""
-    mae = np.mean(np.abs(y1-y2))
-    rmse = np.sqrt(np.mean((y1-y2) ** 2))
+    diff = valid_values(y1 - y2)
+    mae = np.abs(diff).mean()
+    rmse = np.sqrt(np.dot(diff, diff) / diff.size)
     t_stat, p_t = stats.ttest_ind(y1, y2)
     return round(mae, 4), round(rmse,4), round(t_stat, 4), round(p_t, 4)
             
@@ -53,8 +86,11 @@ def bland_altman_AC(data, plot_save=False, fig_folder=None):
     diff = data['diff']
     average = data['average']
     
-    mean_diff = np.mean(diff)    
-    std_diff = np.std(diff, ddof=1)
+    # Sample standard deviation from the centered differences in one dot product
+    diff_values = valid_values(diff)
+    mean_diff = diff_values.mean()
+    centered = diff_values - mean_diff
+    std_diff = np.sqrt(np.dot(centered, centered) / (centered.size - 1))
     loa_upper = mean_diff + 1.96 * std_diff
     loa_lower = mean_diff - 1.96 * std_diff
     #print("Agreement metrics: Mean Difference: ", mean_diff)
@@ -62,7 +98,7 @@ def bland_altman_AC(data, plot_save=False, fig_folder=None):
     
     fig, ax = plot_style()
     
-    plt.scatter(average, diff, s=0.5, alpha=0.9)
+    plt.scatter(average, diff, s=0.5, alpha=0.9, rasterized=True)
     plt.axhline(mean_diff, color='gray', linestyle='solid', label='Mean Difference')
     plt.axhline(loa_upper, color='gray', linestyle='--', label='1.96 SD')
     plt.axhline(loa_lower, color='gray', linestyle='--')
@@ -100,23 +136,25 @@ def regression_AC(y1, y2, plot_save=False, fig_folder=None):
 
     fig, ax = plot_style()
 
-    ax.scatter(y1, y2, label='ACs', s = 0.5)    
+    ax.scatter(y1, y2, label='ACs', s = 0.5, rasterized=True)    
     ax.set_title('Regression between WatchAC and ActiAC')#'[' + patient_ID +']')
 
-    model = LinearRegression()
-    X = y1.values.reshape(-1, 1)
-    y = y2.values
-    model = LinearRegression()
-    model.fit(X, y)
-    y_pred = model.predict(X)
-    #print(model.score(X, y))
-    #print(model.coef_, model.intercept_)
+    # Least squares line of a single predictor in closed form
+    x = y1.to_numpy(dtype=np.float64)
+    y = y2.to_numpy(dtype=np.float64)
+    x_centered = x - x.mean()
+    y_centered = y - y.mean()
+    slope = np.dot(x_centered, y_centered) / np.dot(x_centered, x_centered)
+    intercept = y.mean() - slope * x.mean()
+    y_pred = slope * x + intercept
+    residuals = y - y_pred
+    r2 = 1 - np.dot(residuals, residuals) / np.dot(y_centered, y_centered)
     
     corr_coeff, p_corr = pearsonr(y1, y2)
     
     plt.plot(y1, y_pred, color="#696969", lw=1)
-    plt.text(0.8, 0.5, r'$R^2$' + ' = ' +str(round(model.score(X, y), 2)), fontsize=8, va='center', ha='left', transform=ax.transAxes)        
-    plt.text(0.8, 0.4, r'$y$' + ' = ' +str(round(model.coef_[0], 2)) +' * x +' +str(round(model.intercept_, 2)), fontsize=8, va='center', ha='left', transform=ax.transAxes)        
+    plt.text(0.8, 0.5, r'$R^2$' + ' = ' +str(round(r2, 2)), fontsize=8, va='center', ha='left', transform=ax.transAxes)        
+    plt.text(0.8, 0.4, r'$y$' + ' = ' +str(round(slope, 2)) +' * x +' +str(round(intercept, 2)), fontsize=8, va='center', ha='left', transform=ax.transAxes)        
     plt.text(0.8, 0.3, r'$r$' + ' = ' +str(round(corr_coeff, 4)), fontsize=8, va='center', ha='left', transform=ax.transAxes)        
     plt.text(0.8, 0.2, r'$p$' + ' = ' +str(round(p_corr, 2)), fontsize=8, va='center', ha='left', transform=ax.transAxes)        
 
@@ -145,8 +183,8 @@ def scatter(x, y1, y2, label1, label2, plot_save=False, fig_folder=None, ylim_lo
 
     fig, ax = plot_style()
 
-    ax.scatter(x, y1, label=label1, s=0.5)
-    ax.scatter(x, y2, label=label2, s=0.5)
+    ax.scatter(x, y1, label=label1, s=0.5, rasterized=True)
+    ax.scatter(x, y2, label=label2, s=0.5, rasterized=True)
     ax.set_title(label1 + 'and' + label2)
     
     plt.xlabel("Time", fontsize=8)